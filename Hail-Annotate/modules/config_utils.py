@@ -8,11 +8,19 @@ and perform checks for required fields and their types.
 
 from google.cloud import storage
 from google.cloud.exceptions import NotFound, Forbidden
+import functools
 import json
 import re
 import os
 
 
+# IAM permissions needed to read a bucket
+READ_PERMISSIONS = ('storage.objects.list', 'storage.objects.get')
+
+# environment variable naming a local directory to serve gs:// paths from
+LOCAL_STORAGE_ENV = 'HAIL_ANNOTATE_LOCAL_STORAGE'
+
+
 def parse_gcs_path(gcs_path):
     """Get bucket and blob from a GCS path
 
@@ -22,8 +30,7 @@ def parse_gcs_path(gcs_path):
     :rtype: tuple
     """    
     gcs_path  = gcs_path.replace('gs://','')
-    bucket = os.path.dirname(gcs_path)
-    blob = os.path.basename(gcs_path)
+    bucket, _, blob = gcs_path.partition('/')
     return bucket, blob
 
 
@@ -39,6 +46,80 @@ def is_valid_gcs_path(gcs_path):
     return re.match(pattern, gcs_path) is not None
 
 
+@functools.lru_cache(maxsize=None)
+def get_storage_client():
+    """Return the process-wide Google Cloud Storage client.
+
+    :return: Shared storage client
+    :rtype: google.cloud.storage.Client
+    """
+
+    return storage.Client()
+
+
+class GCSStorageBackend:
+    """Bucket checks and object reads against Google Cloud Storage, sharing
+    one pooled client. Every check costs a constant number of requests,
+    regardless of how many objects a bucket holds."""
+
+    def bucket_exists(self, bucket_name):
+        try:
+            return get_storage_client().bucket(bucket_name).exists()
+        except Forbidden:
+            # the bucket exists, we just cannot read its metadata
+            return True
+
+    def has_permission(self, bucket_name, permissions=READ_PERMISSIONS):
+        try:
+            bucket = get_storage_client().bucket(bucket_name)
+            granted = bucket.test_iam_permissions(list(permissions))
+        except (Forbidden, NotFound):
+            return False
+        return set(permissions).issubset(granted)
+
+    def read_text(self, gcs_path):
+        bucket, blob = parse_gcs_path(gcs_path)
+        return get_storage_client().bucket(bucket).blob(blob).download_as_text()
+
+
+class LocalStorageBackend:
+    """Bucket checks and object reads against a local directory, where
+    gs://bucket/blob maps to <root>/bucket/blob. Lets config checks run
+    offline."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket_name, blob=''):
+        return os.path.join(self.root, bucket_name, blob)
+
+    def bucket_exists(self, bucket_name):
+        return os.path.isdir(self._path(bucket_name))
+
+    def has_permission(self, bucket_name, permissions=READ_PERMISSIONS):
+        return os.access(self._path(bucket_name), os.R_OK)
+
+    def read_text(self, gcs_path):
+        with open(self._path(*parse_gcs_path(gcs_path))) as f:
+            return f.read()
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage_backend():
+    """Return the storage backend for this process. Setting the
+    HAIL_ANNOTATE_LOCAL_STORAGE environment variable to a directory serves
+    gs:// paths from that directory instead of Google Cloud Storage.
+
+    :return: Storage backend
+    :rtype: GCSStorageBackend or LocalStorageBackend
+    """
+
+    local_root = os.environ.get(LOCAL_STORAGE_ENV)
+    if local_root:
+        return LocalStorageBackend(local_root)
+    return GCSStorageBackend()
+
+
 def check_bucket_exists(bucket_name):
     """Check if a GCS bucket exists.
 
@@ -48,16 +129,12 @@ def check_bucket_exists(bucket_name):
     :rtype: bool
     """
 
-    storage_client = storage.Client()
-    try:
-        bucket = storage_client.get_bucket(bucket_name)
-        return True
-    except NotFound:
-        return False
+    return get_storage_backend().bucket_exists(bucket_name)
 
 
 def check_bucket_permission(bucket_name):
-    """Check if current account has permission to read bucket
+    """Check if current account has permission to read bucket. Uses an IAM
+    permission test, so the cost does not depend on the bucket's size.
 
     :param bucket_name: Name of target bucket with "bucket-name" format (no gs:// prefix)
     :type bucket_name: str
@@ -65,14 +142,7 @@ def check_bucket_permission(bucket_name):
     :rtype: bool
     """
 
-    storage_client = storage.Client()
-    try:
-        bucket = storage_client.get_bucket(bucket_name)
-        # Attempt to list blobs in the bucket to check permission
-        blobs = list(bucket.list_blobs())
-        return True
-    except Forbidden:
-        return False
+    return get_storage_backend().has_permission(bucket_name)
 
 
 def check_gcs_path(gcs_path):
@@ -93,26 +163,28 @@ def check_gcs_path(gcs_path):
     return exists, has_permission
 
 
-def load_config(gcs_path):
-    """Read input config for a Hail annotation project.
+@functools.lru_cache(maxsize=None)
+def fetch_config_text(gcs_path):
+    """Fetch the raw text of a config, once per path and process.
 
     :param gcs_path: Path to Google Cloud config.json file
     :type gcs_path: str
+    :return: Config file contents
+    :rtype: str
     """
 
-    # parse bucket/blob format
-    bucket, blob = parse_gcs_path(gcs_path)
+    return get_storage_backend().read_text(gcs_path)
 
-    # connect to bucket
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket)
-    blob = bucket.blob(blob)
 
-    # read json
-    with blob.open("r") as f:
-        config = json.load(f)
+def load_config(gcs_path):
+    """Read input config for a Hail annotation project.
+
+    :param gcs_path: Path to Google Cloud config.json file
+    :type gcs_path: str
+    """
 
-    return config
+    # parse a fresh copy of the memoized text, so callers may modify it
+    return json.loads(fetch_config_text(gcs_path))
 
 
 def check_fields(config):
@@ -215,7 +287,7 @@ def import_config(gcs_path):
     """    
 
     # check that google cloud path is valid
-    if not is_valid_gcs_path:
+    if not is_valid_gcs_path(gcs_path):
         raise Exception("Invalid GCS-path to config!")
     exists, has_permissions = check_gcs_path(gcs_path)
     if not all([exists, has_permissions]):
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic-data benchmarks for the Hail annotation pipeline.
+
+Generates an input VCF and GnomAD-shaped exome/genome tables, then times
+each pipeline stage in Hail local mode, ingesting the input the way a run
+with the same config does. Stages are checkpointed so every timing covers
+only its own work. Memory is sampled over the whole driver process tree,
+which includes the Spark JVM. Results are written to a JSON report.
+
+    python benchmarks/benchmark_pipeline.py --n-variants 100000 \
+        --contigs 1,2,22 --multiallelic-fraction 0.05 --report bench.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+import hail as hl
+import numpy as np
+import pandas as pd
+import psutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hail_annotation as ha
+
+
+BASES = np.array(['A', 'C', 'G', 'T'])
+
+# seconds between memory samples of the driver process tree
+MEMORY_SAMPLE_INTERVAL = 0.1
+
+
+def peak_python_memory_mb():
+    """Peak resident memory of the Python process alone, in MB.
+
+    :return: Peak RSS in MB.
+    :rtype: float
+    """
+
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def driver_memory_mb():
+    """Current resident memory of the Python process and its children, in
+    MB. The Spark driver JVM is a child process started through py4j.
+
+    :return: RSS in MB.
+    :rtype: float
+    """
+
+    process = psutil.Process()
+    total = 0
+    for i in [process] + process.children(recursive=True):
+        try:
+            total += i.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total / 1024 ** 2
+
+
+class MemorySampler:
+    """Track the peak of `driver_memory_mb` in a background thread."""
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, driver_memory_mb())
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, driver_memory_mb())
+
+
+def random_positions(contigs, n_variants, rng):
+    """Draw contigs uniformly and a position within each contig's GRCh37 length.
+
+    :param contigs: Contigs to draw from.
+    :type contigs: list
+    :param n_variants: Number of positions to draw.
+    :type n_variants: int
+    :param rng: Random generator.
+    :type rng: np.random.Generator
+    :return: tuple with arrays of contigs and positions
+    :rtype: tuple
+    """
+
+    lengths = hl.get_reference('GRCh37').lengths
+    contigs = np.array(contigs)
+    idx = rng.integers(0, len(contigs), n_variants)
+    lens = np.array([lengths[c] for c in contigs])
+    return contigs[idx], rng.integers(1, lens[idx])
+
+
+def alt_base(refs, offsets):
+    """Shift each reference base by an offset in 1-3, giving a different base.
+
+    :param refs: Array of reference bases.
+    :type refs: np.ndarray
+    :param offsets: Array of offsets in 1-3.
+    :type offsets: np.ndarray
+    :return: Array of alternate bases.
+    :rtype: np.ndarray
+    """
+
+    return BASES[(np.searchsorted(BASES, refs) + offsets) % 4]
+
+
+def generate_input_vcf(path, n_variants, contigs, multiallelic_fraction, rng):
+    """Write a synthetic sites VCF with SNVs on the requested contigs.
+
+    :param path: Local path to write the VCF to.
+    :type path: str
+    :param n_variants: Number of VCF rows.
+    :type n_variants: int
+    :param contigs: Contigs to draw variants from, uniformly.
+    :type contigs: list
+    :param multiallelic_fraction: Fraction of rows with two alternate alleles.
+    :type multiallelic_fraction: float
+    :param rng: Random generator.
+    :type rng: np.random.Generator
+    :return: The written rows.
+    :rtype: pd.DataFrame
+    """
+
+    chrom, pos = random_positions(contigs, n_variants, rng)
+    ref = rng.choice(BASES, n_variants)
+    offsets = rng.integers(1, 4, n_variants)
+    alt = alt_base(ref, offsets)
+
+    # add a distinct second alternate allele to a fraction of rows
+    multi = rng.random(n_variants) < multiallelic_fraction
+    second = alt_base(ref, offsets % 3 + 1)
+    alt = np.where(multi, np.char.add(np.char.add(alt, ','), second), alt)
+
+    df = pd.DataFrame({'CHROM': chrom, 'POS': pos, 'ID': '.', 'REF': ref, 'ALT': alt})
+    with open(path, 'w') as f:
+        f.write('##fileformat=VCFv4.2\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\n')
+        df.to_csv(f, sep='\t', index=False, header=False)
+
+    return df
+
+
+def generate_gnomad_table(path, input_df, hit_fraction, n_extra, rng):
+    """Write a GnomAD-shaped sites table with `freq` and `popmax` arrays of structs.
+
+    :param path: Path to write the Hail table to.
+    :type path: str
+    :param input_df: Rows of the synthetic input VCF.
+    :type input_df: pd.DataFrame
+    :param hit_fraction: Fraction of biallelic input variants present in the table.
+    :type hit_fraction: float
+    :param n_extra: Number of additional variants not in the input.
+    :type n_extra: int
+    :param rng: Random generator.
+    :type rng: np.random.Generator
+    """
+
+    # split input alleles, then keep a fraction of them as GnomAD hits
+    split = input_df.assign(ALT=input_df.ALT.str.split(',')).explode('ALT')
+    hits = split[rng.random(len(split)) < hit_fraction][['CHROM', 'POS', 'REF', 'ALT']]
+
+    extra_chrom, extra_pos = random_positions(list(input_df.CHROM.unique()), n_extra, rng)
+    extra_ref = rng.choice(BASES, n_extra)
+    extra = pd.DataFrame({'CHROM': extra_chrom,
+                          'POS': extra_pos,
+                          'REF': extra_ref,
+                          'ALT': alt_base(extra_ref, rng.integers(1, 4, n_extra))})
+
+    df = pd.concat([hits, extra]).drop_duplicates(['CHROM', 'POS', 'REF', 'ALT'])
+    df = df.assign(AF=rng.beta(0.5, 20, len(df)))
+    df = df.assign(POPMAX=np.minimum(1.0, df.AF * rng.uniform(1, 3, len(df))))
+    df['POS'] = df.POS.astype(np.int32)
+
+    ht = hl.Table.from_pandas(df)
+    ht = ht.key_by(locus=hl.locus(ht.CHROM, ht.POS, reference_genome='GRCh37'),
+                   alleles=[ht.REF, ht.ALT])
+    ht = ht.select(freq=[hl.struct(AF=ht.AF)],
+                   popmax=[hl.struct(AF=ht.POPMAX)])
+    ht.write(path, overwrite=True)
+
+
+class StageTimer:
+    """Collect wall time, throughput and driver memory for pipeline stages."""
+
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, n_variants, func, *args, **kwargs):
+        with MemorySampler() as memory:
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            seconds = time.perf_counter() - start
+        self.stages.append({'stage': name,
+                            'seconds': round(seconds, 3),
+                            'variants': n_variants,
+                            'variants_per_sec': round(n_variants / seconds, 1) if seconds > 0 else None,
+                            'peak_driver_rss_mb': round(memory.peak, 1),
+                            'peak_python_rss_mb': round(peak_python_memory_mb(), 1)})
+        print(f"{name}: {seconds:.2f}s")
+        return result
+
+
+def run_benchmark(args):
+    """Generate synthetic data and time each stage of the pipeline.
+
+    :param args: Parsed command line arguments.
+    :type args: argparse.Namespace
+    :return: Benchmark report.
+    :rtype: dict
+    """
+
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    contigs = args.contigs.split(',')
+
+    # synthetic inputs
+    vcf_path = os.path.join(work_dir, 'input.vcf')
+    input_df = generate_input_vcf(vcf_path, args.n_variants, contigs, args.multiallelic_fraction, rng)
+    for db in ['exomes', 'genomes']:
+        generate_gnomad_table(os.path.join(work_dir, f'{db}.ht'), input_df,
+                              args.hit_fraction, args.n_reference_extra, rng)
+
+    config = {
+        'gnomad-paths': {db: {'value': f'file://{work_dir}/{db}.ht', 'type': 'string'}
+                         for db in ['exomes', 'genomes']},
+        'script-params': {
+            'testing': {'value': False, 'type': 'boolean'},
+            'allele-frequency-cutoff': {'value': args.af_cutoff, 'type': 'float'},
+            'input-vcf': {'value': vcf_path, 'type': 'string'},
+            'output-name': {'value': f'file://{work_dir}/output.tsv', 'type': 'string'},
+        }
+    }
+
+    if args.ingest_mode is not None:
+        config['script-params']['ingest-mode'] = {'value': args.ingest_mode, 'type': 'string'}
+    if args.sites_only is not None:
+        config['script-params']['sites-only'] = {'value': args.sites_only == 'true', 'type': 'boolean'}
+
+    n = args.n_variants
+    timer = StageTimer()
+    checkpoint = lambda obj, name: obj.checkpoint(
+        f'file://{work_dir}/{name}' + ('.mt' if isinstance(obj, hl.MatrixTable) else '.ht'), overwrite=True)
+
+    # ingest with the config's settings (sites-only by default), as a run does
+    vcf = timer.run('import_input', n,
+                    lambda: checkpoint(ha.import_input(config, staging_dir=f'file://{work_dir}/'), 'split'))
+    n_split = vcf.count_rows() if isinstance(vcf, hl.MatrixTable) else vcf.count()
+
+    intervals = timer.run('locus_intervals', n_split, ha.locus_intervals, vcf)
+    for db in ['exomes', 'genomes']:
+        vcf = timer.run(f'add_db_annotations_{db}', n_split,
+                        lambda: checkpoint(ha.add_db_annotations(vcf, db, config, intervals), db))
+
+    fields = ha.annotation_fields(config)
+    if isinstance(vcf, hl.MatrixTable):
+        vcf = vcf.annotate_rows(variant=ha.variant_id(vcf.locus, vcf.alleles))
+        export = ha.export_entries(vcf, fields)
+    else:
+        vcf = vcf.annotate(variant=ha.variant_id(vcf.locus, vcf.alleles))
+        export = ha.export_rows(vcf, fields)
+    timer.run('export', n_split, ha.export_annotations,
+              export, f'file://{work_dir}/output' + ha.OUTPUT_EXTENSIONS[args.output_format], args.output_format)
+
+    return {'parameters': vars(args),
+            'split_variants': n_split,
+            'stages': timer.stages}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the annotation pipeline on synthetic data in Hail local mode.')
+    parser.add_argument('--n-variants', type=int, default=100_000,
+                        help='Number of rows in the synthetic input VCF.')
+    parser.add_argument('--contigs', type=str, default='1,2,22',
+                        help='Comma-separated GRCh37 contigs to draw variants from.')
+    parser.add_argument('--multiallelic-fraction', type=float, default=0.05,
+                        help='Fraction of input rows with two alternate alleles.')
+    parser.add_argument('--hit-fraction', type=float, default=0.5,
+                        help='Fraction of input variants present in the synthetic GnomAD tables.')
+    parser.add_argument('--n-reference-extra', type=int, default=100_000,
+                        help='Number of synthetic GnomAD variants not present in the input.')
+    parser.add_argument('--af-cutoff', type=float, default=0.1,
+                        help='Allele frequency cutoff applied by add_db_annotations.')
+    parser.add_argument('--output-format', type=str, default='tsv', choices=ha.OUTPUT_FORMATS,
+                        help='Output format used for the export stage.')
+    parser.add_argument('--ingest-mode', type=str, choices=ha.INGEST_MODES,
+                        help='Ingest mode to benchmark (default: the pipeline default).')
+    parser.add_argument('--sites-only', type=str, choices=['true', 'false'],
+                        help='Benchmark the sites-only Table path or the MatrixTable path (default: the pipeline default).')
+    parser.add_argument('--cores', type=str, default='*',
+                        help='Number of local Spark cores.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for synthetic data.')
+    parser.add_argument('--work-dir', type=str, default='/tmp/hail-annotate-benchmark',
+                        help='Local directory for synthetic data and checkpoints.')
+    parser.add_argument('--report', type=str, default='benchmark-report.json',
+                        help='Path of the JSON report.')
+    args = parser.parse_args()
+
+    hl.init(master=f'local[{args.cores}]', quiet=True, default_reference='GRCh37')
+    report = run_benchmark(args)
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Wrote benchmark report to {args.report}.")
@@ -6,17 +6,44 @@ Created on Fri Jul 21 09:13:35 2023
 @author: bbowles1
 """
 
-from google.cloud import storage
-from google.cloud.exceptions import NotFound, Forbidden
 import json
 import re
 import os
 
-import hail as hl
+import fsspec
 import pandas as pd
 import numpy as np
-import subprocess
 import argparse
+import concurrent.futures
+import contextlib
+import copy
+import fcntl
+import functools
+import gzip
+import hashlib
+import http.server
+import importlib
+import shutil
+import threading
+import time
+import uuid
+
+
+class LazyModule:
+    """Import a module on first attribute access. The local engine never
+    touches Hail or the Cloud Storage client, so it does not pay seconds of
+    import time for them."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+hl = LazyModule('hail')
+storage = LazyModule('google.cloud.storage')
+gcs_exceptions = LazyModule('google.cloud.exceptions')
 
 # ====================================== #
 #    ____ ___  _   _ _____ ___ ____      #
@@ -27,6 +54,35 @@ import argparse
 #                                        #
 # ====================================== #
 
+# IAM permissions needed to read a bucket
+READ_PERMISSIONS = ('storage.objects.list', 'storage.objects.get')
+
+# IAM permissions needed to write outputs to a bucket
+WRITE_PERMISSIONS = ('storage.objects.list', 'storage.objects.get', 'storage.objects.create')
+
+# key types of an 'annotation-sources' table; 'interval' sources are BED files
+SOURCE_KEY_TYPES = ['locus-alleles', 'locus', 'interval']
+
+# field expressions of 'interval' sources that summarise the overlapping regions
+REGION_EXPRS = ['overlaps', 'count']
+
+# field expressions of an annotation source, e.g. 'freq.AF[0]'
+SOURCE_EXPR_PATTERN = re.compile(r'^[A-Za-z_]\w*(\.[A-Za-z_]\w*|\[\d+\])*$')
+
+# output columns and field expressions of the default GnomAD sources;
+# the first column of each is filtered on allele frequency
+GNOMAD_FIELDS = {'exomes': {'efreq': 'freq.AF[0]', 'epopmax': 'popmax.AF[0]'},
+                 'genomes': {'gfreq': 'freq.AF[0]', 'gpopmax': 'popmax.AF[0]'}}
+
+# 'script-params' entries that are written to rather than read
+OUTPUT_PARAMS = ['output-name', 'annotation-cache', 'work-dir']
+
+# number of preflight checks run at once
+PREFLIGHT_THREADS = 16
+
+# environment variable naming a local directory to serve gs:// paths from
+LOCAL_STORAGE_ENV = 'HAIL_ANNOTATE_LOCAL_STORAGE'
+
 
 def parse_gcs_path(gcs_path):
     """Get bucket and blob from a GCS path
@@ -37,8 +93,7 @@ def parse_gcs_path(gcs_path):
     :rtype: tuple
     """    
     gcs_path  = gcs_path.replace('gs://','')
-    bucket = os.path.dirname(gcs_path)
-    blob = os.path.basename(gcs_path)
+    bucket, _, blob = gcs_path.partition('/')
     return bucket, blob
 
 
@@ -54,6 +109,153 @@ def is_valid_gcs_path(gcs_path):
     return re.match(pattern, gcs_path) is not None
 
 
+@functools.lru_cache(maxsize=None)
+def get_storage_client():
+    """Return the process-wide Google Cloud Storage client.
+
+    :return: Shared storage client
+    :rtype: google.cloud.storage.Client
+    """
+
+    return storage.Client()
+
+
+class GCSStorageBackend:
+    """Bucket checks and object reads against Google Cloud Storage, sharing
+    one pooled client. Every check costs a constant number of requests,
+    regardless of how many objects a bucket holds."""
+
+    def bucket_exists(self, bucket_name):
+        try:
+            return get_storage_client().bucket(bucket_name).exists()
+        except gcs_exceptions.Forbidden:
+            # the bucket exists, we just cannot read its metadata
+            return True
+
+    def has_permission(self, bucket_name, permissions=READ_PERMISSIONS):
+        try:
+            bucket = get_storage_client().bucket(bucket_name)
+            granted = bucket.test_iam_permissions(list(permissions))
+        except (gcs_exceptions.Forbidden, gcs_exceptions.NotFound):
+            return False
+        return set(permissions).issubset(granted)
+
+    def read_text(self, gcs_path):
+        bucket, blob = parse_gcs_path(gcs_path)
+        return get_storage_client().bucket(bucket).blob(blob).download_as_text()
+
+    def read_bytes(self, gcs_path):
+        bucket, blob = parse_gcs_path(gcs_path)
+        return get_storage_client().bucket(bucket).blob(blob).download_as_bytes()
+
+    def blob_exists(self, gcs_path):
+        bucket, blob = parse_gcs_path(gcs_path)
+        return get_storage_client().bucket(bucket).blob(blob).exists()
+
+    def blob_size(self, gcs_path):
+        bucket, blob = parse_gcs_path(gcs_path)
+        blob = get_storage_client().bucket(bucket).get_blob(blob)
+        return None if blob is None else blob.size
+
+    def read_versioned(self, gcs_path):
+        # object generation 0 means the object does not exist yet
+        bucket, blob = parse_gcs_path(gcs_path)
+        blob = get_storage_client().bucket(bucket).get_blob(blob)
+        if blob is None:
+            return None, 0
+        return blob.download_as_text(if_generation_match=blob.generation), blob.generation
+
+    def write_if_version(self, gcs_path, text, version):
+        # compare-and-swap on the object generation read by read_versioned
+        bucket, blob = parse_gcs_path(gcs_path)
+        try:
+            get_storage_client().bucket(bucket).blob(blob).upload_from_string(text, if_generation_match=version)
+        except gcs_exceptions.PreconditionFailed:
+            return False
+        return True
+
+    def delete_prefix(self, gcs_path):
+        bucket, prefix = parse_gcs_path(gcs_path.rstrip('/') + '/')
+        for blob in get_storage_client().list_blobs(bucket, prefix=prefix):
+            blob.delete()
+
+
+class LocalStorageBackend:
+    """Bucket checks and object reads against a local directory, where
+    gs://bucket/blob maps to <root>/bucket/blob. Lets preflight checks run
+    offline."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket_name, blob=''):
+        return os.path.join(self.root, bucket_name, blob)
+
+    def bucket_exists(self, bucket_name):
+        return os.path.isdir(self._path(bucket_name))
+
+    def has_permission(self, bucket_name, permissions=READ_PERMISSIONS):
+        mode = os.R_OK | (os.W_OK if 'storage.objects.create' in permissions else 0)
+        return os.access(self._path(bucket_name), mode)
+
+    def read_text(self, gcs_path):
+        with open(self._path(*parse_gcs_path(gcs_path))) as f:
+            return f.read()
+
+    def read_bytes(self, gcs_path):
+        with open(self._path(*parse_gcs_path(gcs_path)), 'rb') as f:
+            return f.read()
+
+    def blob_exists(self, gcs_path):
+        return os.path.isfile(self._path(*parse_gcs_path(gcs_path)))
+
+    def blob_size(self, gcs_path):
+        path = self._path(*parse_gcs_path(gcs_path))
+        return os.path.getsize(path) if os.path.isfile(path) else None
+
+    def read_versioned(self, gcs_path):
+        path = self._path(*parse_gcs_path(gcs_path))
+        if not os.path.isfile(path):
+            return None, 0
+        with open(path) as f:
+            stat = os.stat(f.fileno())
+            return f.read(), f'{stat.st_ino}.{stat.st_mtime_ns}'
+
+    def write_if_version(self, gcs_path, text, version):
+        # hold a lock file while comparing and replacing, like a generation match
+        path = self._path(*parse_gcs_path(gcs_path))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stat = os.stat(path) if os.path.isfile(path) else None
+            current = 0 if stat is None else f'{stat.st_ino}.{stat.st_mtime_ns}'
+            if current != version:
+                return False
+            with open(path + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(path + '.tmp', path)
+        return True
+
+    def delete_prefix(self, gcs_path):
+        shutil.rmtree(self._path(*parse_gcs_path(gcs_path.rstrip('/') + '/')), ignore_errors=True)
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage_backend():
+    """Return the storage backend for this process. Setting the
+    HAIL_ANNOTATE_LOCAL_STORAGE environment variable to a directory serves
+    gs:// paths from that directory instead of Google Cloud Storage.
+
+    :return: Storage backend
+    :rtype: GCSStorageBackend or LocalStorageBackend
+    """
+
+    local_root = os.environ.get(LOCAL_STORAGE_ENV)
+    if local_root:
+        return LocalStorageBackend(local_root)
+    return GCSStorageBackend()
+
+
 def check_bucket_exists(bucket_name):
     """Check if a GCS bucket exists.
 
@@ -63,16 +265,12 @@ def check_bucket_exists(bucket_name):
     :rtype: bool
     """
 
-    storage_client = storage.Client()
-    try:
-        bucket = storage_client.get_bucket(bucket_name)
-        return True
-    except NotFound:
-        return False
+    return get_storage_backend().bucket_exists(bucket_name)
 
 
 def check_bucket_permission(bucket_name):
-    """Check if current account has permission to read bucket
+    """Check if current account has permission to read bucket. Uses an IAM
+    permission test, so the cost does not depend on the bucket's size.
 
     :param bucket_name: Name of target bucket with "bucket-name" format (no gs:// prefix)
     :type bucket_name: str
@@ -80,14 +278,7 @@ def check_bucket_permission(bucket_name):
     :rtype: bool
     """
 
-    storage_client = storage.Client()
-    try:
-        bucket = storage_client.get_bucket(bucket_name)
-        # Attempt to list blobs in the bucket to check permission
-        blobs = list(bucket.list_blobs())
-        return True
-    except Forbidden:
-        return False
+    return get_storage_backend().has_permission(bucket_name)
 
 
 def check_gcs_path(gcs_path):
@@ -108,26 +299,28 @@ def check_gcs_path(gcs_path):
     return exists, has_permission
 
 
-def load_config(gcs_path):
-    """Read input config for a Hail annotation project.
+@functools.lru_cache(maxsize=None)
+def fetch_config_text(gcs_path):
+    """Fetch the raw text of a config, once per path and process.
 
     :param gcs_path: Path to Google Cloud config.json file
     :type gcs_path: str
+    :return: Config file contents
+    :rtype: str
     """
 
-    # parse bucket/blob format
-    bucket, blob = parse_gcs_path(gcs_path)
+    return get_storage_backend().read_text(gcs_path)
 
-    # connect to bucket
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket)
-    blob = bucket.blob(blob)
 
-    # read json
-    with blob.open("r") as f:
-        config = json.load(f)
+def load_config(gcs_path):
+    """Read input config for a Hail annotation project.
 
-    return config
+    :param gcs_path: Path to Google Cloud config.json file
+    :type gcs_path: str
+    """
+
+    # parse a fresh copy of the memoized text, so callers may modify it
+    return json.loads(fetch_config_text(gcs_path))
 
 
 def check_fields(config):
@@ -140,8 +333,8 @@ def check_fields(config):
     :raises Exception: Script parameters are missing from input json.
     """    
     
-    # define expected fields
-    level1_keys = ['gnomad-paths','script-params']
+    # define expected fields; GnomAD tables are only required when they make up the default sources
+    level1_keys = ['script-params'] if 'annotation-sources' in config else ['gnomad-paths','script-params']
     gnomad_keys = ['exomes','genomes']
     script_params = ['testing', 'allele-frequency-cutoff', 'input-vcf', 'output-name']
 
@@ -151,8 +344,8 @@ def check_fields(config):
         raise Exception(except_str)
         
         
-    missing_keys = [i for i in gnomad_keys if i not in config['gnomad-paths'].keys()]
-    if missing_keys:
+    missing_keys = [i for i in gnomad_keys if i not in config.get('gnomad-paths', {}).keys()]
+    if missing_keys and 'annotation-sources' not in config:
         except_str = f"The following keys are missing from the 'gnomad_keys' level of your config: {', '.join(missing_keys)}."
         raise Exception(except_str)  
         
@@ -169,15 +362,16 @@ def check_types(configvalue, configtype):
 
     :param configvalue: 'value' field of config leaf node.
     :type configvalue: object (variable type)
-    :param configtype: Expected type of config ('google-cloud-path','float','boolean','hdfs-path')
+    :param configtype: Expected type of config ('google-cloud-path','float','boolean','string','integer')
     :type configtype: str
     :raises Exception: Invalid 'type' field was provided.
     :raises Exception: Invalid gcs_path was provided.
     :raises Exception: Input config value must be a float.
     :raises Exception: Input config value must be a boolean.
     :raises Exception: Input config value must be a string.
+    :raises Exception: Input config value must be an integer.
     """    
-    types = ['google-cloud-path','float','boolean', 'string']
+    types = ['google-cloud-path','float','boolean', 'string', 'integer', 'annotation-source']
     
     if configtype not in types:
         raise Exception(f"Type {configtype} is invalid! Expecting values in: {types}.")
@@ -198,6 +392,47 @@ def check_types(configvalue, configtype):
         if not isinstance(configvalue, str):
             raise Exception(f"Input config value {configvalue} must be string!")
 
+    if configtype == 'integer':
+        if not isinstance(configvalue, int) or isinstance(configvalue, bool):
+            raise Exception(f"Input config value {configvalue} must be an integer!")
+
+    if configtype == 'annotation-source':
+        check_annotation_source(configvalue)
+
+
+def check_annotation_source(source):
+    """Check the value of an 'annotation-sources' entry, e.g.
+    {"path": "gs://...", "key": "locus-alleles",
+     "fields": {"efreq": {"expr": "freq.AF[0]", "default": 0.0, "af-filter": true}}}
+
+    :param source: 'value' field of an annotation source.
+    :type source: dict
+    :raises Exception: Source is not an object with a valid GCS 'path'.
+    :raises Exception: Invalid 'key' type.
+    :raises Exception: Source declares no fields.
+    :raises Exception: Invalid field expression, default or af-filter flag.
+    :raises Exception: af-filter is set on a region track.
+    """
+
+    if not isinstance(source, dict) or not is_valid_gcs_path(str(source.get('path'))):
+        raise Exception(f"Annotation source {source} must be an object with a valid GCS 'path'!")
+
+    if source.get('key', 'locus-alleles') not in SOURCE_KEY_TYPES:
+        raise Exception(f"Annotation source key {source['key']} is invalid! Expecting values in: {SOURCE_KEY_TYPES}.")
+
+    if not isinstance(source.get('fields'), dict) or not source['fields']:
+        raise Exception(f"Annotation source {source['path']} must declare at least one field!")
+
+    for column, field in source['fields'].items():
+        if not isinstance(field, dict) or not isinstance(field.get('expr'), str) or not SOURCE_EXPR_PATTERN.match(field['expr']):
+            raise Exception(f"Field expression for {column} is invalid! Expecting e.g. 'freq.AF[0]'.")
+        if not isinstance(field.get('default', 0.0), (int, float, str, type(None))):
+            raise Exception(f"Default {field['default']} for {column} must be a number, string or null!")
+        if not isinstance(field.get('af-filter', False), bool):
+            raise Exception(f"af-filter for {column} must be True or False!")
+        if field.get('af-filter', False) and source.get('key') == 'interval':
+            raise Exception(f"af-filter for {column} cannot be set on a region track!")
+
 def check_config_types(config):
     """Check input config for expected data types.
 
@@ -216,6 +451,88 @@ def check_config_types(config):
                 # check that value is expected type
                 check_types(configvalue, configtype)
 
+
+def gnomad_sources(config):
+    """Build annotation sources for the exome and genome tables in
+    'gnomad-paths', with missing frequencies filled as 0.0.
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :return: Annotation sources keyed by name.
+    :rtype: dict
+    """
+
+    return {db: {'path': config['gnomad-paths'][db]['value'],
+                 'key': 'locus-alleles',
+                 'fields': {column: {'expr': expr, 'default': 0.0, 'af-filter': i == 0}
+                            for i, (column, expr) in enumerate(fields.items())}}
+            for db, fields in GNOMAD_FIELDS.items()}
+
+
+def annotation_sources(config):
+    """Return the annotation sources of a config, with optional settings
+    filled in. Without an 'annotation-sources' section the GnomAD tables
+    are used, or the 'reduced-reference' table when it is listed.
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :return: Mapping of source name to path, key type and fields. Each field
+    maps an output column to its expression, fill default and af-filter flag.
+    :rtype: dict
+    """
+
+    if 'annotation-sources' in config:
+        sources = {name: entry['value'] for name, entry in config['annotation-sources'].items()}
+    elif 'reduced-reference' in config.get('gnomad-paths', {}):
+        # the reduced reference stores every GnomAD column under its output name
+        fields = {column: {'expr': column, 'default': field['default'], 'af-filter': field['af-filter']}
+                  for source in gnomad_sources(config).values()
+                  for column, field in source['fields'].items()}
+        sources = {'reduced-reference': {'path': config['gnomad-paths']['reduced-reference']['value'],
+                                         'fields': fields}}
+    else:
+        sources = gnomad_sources(config)
+
+    return {name: {'path': source['path'],
+                   'key': source.get('key', 'locus-alleles'),
+                   'fields': {column: {'expr': field['expr'],
+                                       'default': field.get('default'),
+                                       'af-filter': field.get('af-filter', False)}
+                              for column, field in source['fields'].items()}}
+            for name, source in sources.items()}
+
+
+def check_annotation_columns(config):
+    """Check that annotation sources do not write the same output column.
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :raises Exception: Output column is declared by more than one source.
+    """
+
+    columns = [column for source in annotation_sources(config).values() for column in source['fields']]
+    duplicates = sorted(set([i for i in columns if columns.count(i) > 1]))
+    if duplicates:
+        raise Exception(f"The following output columns are declared by more than one annotation source: {', '.join(duplicates)}.")
+
+
+def get_param(config, key, default=None):
+    """Return the value of an optional 'script-params' entry.
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :param key: Name of the 'script-params' entry.
+    :type key: str
+    :param default: Value returned when the entry is not present.
+    :type default: object
+    :return: Configured value, or `default`.
+    :rtype: object
+    """
+
+    if key in config['script-params']:
+        return config['script-params'][key]['value']
+    return default
+
      
 def import_config(gcs_path):
     """Main function of this file. Wraps basic type, permission
@@ -230,7 +547,7 @@ def import_config(gcs_path):
     """    
 
     # check that google cloud path is valid
-    if not is_valid_gcs_path:
+    if not is_valid_gcs_path(gcs_path):
         raise Exception("Invalid GCS-path to config!")
     exists, has_permissions = check_gcs_path(gcs_path)
     if not all([exists, has_permissions]):
@@ -245,10 +562,192 @@ def import_config(gcs_path):
 
     # Check that config types are expected.
     check_config_types(config)
+    check_annotation_columns(config)
+    normalize_output_name(config)
 
     return config
 
 
+def normalize_output_name(config):
+    """Append '.bgz' to the output name of a 'tsv-sharded' output. Hail
+    picks the compression codec from the extension, so shards of other
+    names would be written as plain text.
+
+    :param config: Loaded config.json file, updated in place.
+    :type config: dict
+    """
+
+    output_name = config['script-params']['output-name']
+    if get_param(config, 'output-format', 'tsv') == 'tsv-sharded' and not output_name['value'].rstrip('/').endswith('.bgz'):
+        output_name['value'] = output_name['value'].rstrip('/') + '.bgz'
+        print(f"Writing block-gzipped shards to {output_name['value']}.")
+
+
+def split_top_level(type_str):
+    """Split a comma-separated list in a Hail type string, ignoring commas
+    nested inside brackets.
+
+    :param type_str: Contents of a Hail Struct{...} or similar.
+    :type type_str: str
+    :return: Top-level items
+    :rtype: list
+    """
+
+    items, depth, start = [], 0, 0
+    for i, char in enumerate(type_str):
+        if char in '{[(':
+            depth += 1
+        elif char in '}])':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(type_str[start:i])
+            start = i + 1
+    if type_str[start:]:
+        items.append(type_str[start:])
+    return items
+
+
+@functools.lru_cache(maxsize=None)
+def table_row_fields(table_path):
+    """Read the row schema of a Hail table from its metadata, without
+    touching its data. Memoized, so a long-running server reads it once.
+
+    :param table_path: GCS path to a Hail table directory.
+    :type table_path: str
+    :return: Mapping of top-level row field name to its Hail type string.
+    :rtype: dict
+    """
+
+    metadata_path = table_path.rstrip('/') + '/metadata.json.gz'
+    metadata = json.loads(gzip.decompress(get_storage_backend().read_bytes(metadata_path)))
+
+    # table_type looks like Table{global:Struct{...},key:[...],row:Struct{...}}
+    table_type = metadata['table_type']
+    row_type = table_type[table_type.index('row:Struct{') + len('row:Struct{'):-2]
+
+    fields = {}
+    for field in split_top_level(row_type):
+        name, _, dtype = field.partition(':')
+        fields[name.strip('`')] = dtype
+    return fields
+
+
+def expression_fields(expr):
+    """Return the row field and first nested field read by a field expression.
+
+    :param expr: Field expression, e.g. 'freq.AF[0]'.
+    :type expr: str
+    :return: tuple with the top-level field and a list with the nested field name, if any
+    :rtype: tuple
+    """
+
+    names = re.findall(r'[A-Za-z_]\w*', expr)
+    return names[0], names[1:2]
+
+
+def preflight_source(source):
+    """Check that an annotation source table exists and has the fields its
+    expressions read.
+
+    :param source: Annotation source, as returned by `annotation_sources`.
+    :type source: dict
+    :return: Description of any problem, or None if the check passed.
+    :rtype: str
+    """
+
+    bucket_name, _ = parse_gcs_path(source['path'])
+    if not get_storage_backend().bucket_exists(bucket_name):
+        return f"bucket {bucket_name} does not exist"
+
+    # BED files have no schema to check
+    if source['key'] == 'interval':
+        return None if get_storage_backend().blob_exists(source['path']) else "file does not exist"
+
+    try:
+        fields = table_row_fields(source['path'])
+    except Exception as e:
+        return f"cannot read table metadata ({type(e).__name__}: {e})"
+
+    missing = []
+    for field in source['fields'].values():
+        name, nested = expression_fields(field['expr'])
+        if name not in fields:
+            missing.append(name)
+        missing += [f'{name}.{i}' for i in nested
+                    if name in fields and not re.search(rf'[{{,]`?{i}`?:', fields[name])]
+    if missing:
+        return f"table is missing fields: {', '.join(sorted(set(missing)))}"
+    return None
+
+
+def preflight_path(name, path):
+    """Check that the bucket of a 'script-params' path is usable: readable
+    inputs must exist, and outputs must be writable.
+
+    :param name: Name of the config entry.
+    :type name: str
+    :param path: GCS path from the config entry.
+    :type path: str
+    :return: Description of any problem, or None if the check passed.
+    :rtype: str
+    """
+
+    backend = get_storage_backend()
+    bucket_name, _ = parse_gcs_path(path)
+    if not backend.bucket_exists(bucket_name):
+        return f"bucket {bucket_name} does not exist"
+
+    if name in OUTPUT_PARAMS:
+        if not backend.has_permission(bucket_name, WRITE_PERMISSIONS):
+            return f"no write permission on bucket {bucket_name}"
+        return None
+
+    if not backend.has_permission(bucket_name):
+        return f"no read permission on bucket {bucket_name}"
+    if name == 'input-vcf' and not backend.blob_exists(path):
+        return "file does not exist"
+    return None
+
+
+def preflight(config):
+    """Validate every annotation source and google-cloud-path script parameter
+    in the config concurrently. Source tables are checked for the fields
+    their expressions read by reading their schema only, inputs must exist
+    and output buckets must be writable. Prints one pass/fail line per path.
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :raises Exception: One or more checks failed.
+    """
+
+    sources = annotation_sources(config)
+    checks = [('annotation-sources', name, source['path']) for name, source in sources.items()]
+    checks += [('script-params', name, entry['value'])
+               for name, entry in config['script-params'].items()
+               if entry.get('type') == 'google-cloud-path']
+
+    def run(check):
+        level1key, name, path = check
+        try:
+            if level1key == 'annotation-sources':
+                return preflight_source(sources[name])
+            return preflight_path(name, path)
+        except Exception as e:
+            return f"check failed ({type(e).__name__}: {e})"
+
+    with concurrent.futures.ThreadPoolExecutor(PREFLIGHT_THREADS) as pool:
+        results = list(pool.map(run, checks))
+
+    print("Preflight checks:")
+    for (level1key, name, path), problem in zip(checks, results):
+        status = 'PASS' if problem is None else 'FAIL'
+        print(f"  [{status}] {level1key}/{name}: {path}" + (f" - {problem}" if problem else ""))
+
+    failed = [name for (_, name, _), problem in zip(checks, results) if problem is not None]
+    if failed:
+        raise Exception(f"Preflight failed for: {', '.join(failed)}.")
+
+
 # =============================== #               
 #   _   _    _    ___ _           #
 #  | | | |  / \  |_ _| |          #
@@ -258,362 +757,2672 @@ def import_config(gcs_path):
 #                                 #
 # ================================#
 
-def read_vcf(path):
-    """Import VCF with support for CHROM or #CHROM header
+# name of the placeholder sample carried by the synthetic VCF
+FAKE_SAMPLE = 'GT1'
 
-    :param path: GCP path to VCF
-    :type path: str
-    :return: Imported VCF
-    :rtype: pd.DataFrame
-    """
+# contig sort order of normalized input rows, without 'chr' prefix
+CONTIG_ORDER = [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT', 'M']
 
-    # read header
-    df = pd.read_csv(path,
-                     sep='\t',
-                     nrows=2000,
-                     header=None)
-    
-    # parse for #CHROM field
-    for row in df.itertuples():
-        if any(['#CHROM' in str(i) for i in row[1:]]):
-            cols = list(row)[1:]
-            hash_header=True
-            break
-        if any(['CHROM' in str(i) for i in row[1:]]):
-            cols = list(row)[1:]
-            hash_header=False
-            break
-
-    # import full VCF
-    df = pd.read_csv(path,
-                     sep='\t',
-                     comment='#',
-                     header=None,
-                     names=cols)
-    
-    # cut duplicate header fields
-    if hash_header == False:
-        df = df.iloc[1:]
-    
-    return df
+# supported values of the 'ingest-mode' script parameter
+INGEST_MODES = ['pandas', 'native']
 
+# columns of the synthetic VCF written by fake_vcf
+VCF_COLUMNS = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT', FAKE_SAMPLE]
 
+# columns of a sites-only VCF, without FORMAT and the placeholder sample
+SITES_COLUMNS = VCF_COLUMNS[:8]
 
-def is_vcf(input_df):
-    """Return True if input contains minimum VCF columns
-    (CHROM, POS, REF, ALT).
+# supported values of the 'output-format' script parameter, with the
+# extension of the file or directory they are written to
+OUTPUT_EXTENSIONS = {'tsv': '.tsv',
+                     'tsv-sharded': '.tsv.bgz',
+                     'parquet': '.parquet',
+                     'hail-table': '.ht'}
+OUTPUT_FORMATS = list(OUTPUT_EXTENSIONS)
 
-    :return: True if VCF file contains minimum required headers.
-    :rtype: bool
-    """    
-    
-    # VCF cols are missing
-    if not all([i in input_df.columns for i in ["CHROM","POS","REF","ALT"]]):
-        return False
-        
-    else:
-        return True
+# supported values of the 'engine' script parameter
+ENGINES = ['hail', 'local']
 
+# metadata file of a local frequency index, and where gs:// indexes are downloaded to
+LOCAL_INDEX_META = 'index.json'
+LOCAL_INDEX_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'hail-annotate')
 
-def fake_vcf(input_df,
-             use_chr=True):
-    """Spoof a VCF file structure when passed an input DataFrame containing CHROM, REF, POS, ALT columns. 
-    For all columns in 'ID', 'QUAL', 'FILTER', 'INFO', 'FORMAT', adds any columns which are not present.
-    Added columns will be contain empty data. This script will overwrite any existing information in the 
-    VCF header, ie contig information.
+# leading output columns of a sites export from the Hail path, reproduced
+# by the local engine
+LOCAL_ROW_FIELDS = ['locus', 'alleles', 'rsid', 'qual', 'filters', 'info',
+                    'a_index', 'was_split', 'old_locus', 'old_alleles', 'variant', 's']
 
-    :param input_df: Pandas DataFrame with 'CHROM', 'REF', 'POS', 'ALT' columns.
-    :type input_df: pd.DataFrame
+# target false positive rate of a presence filter, and the INFO field that
+# carries its per-allele result through the staged VCF
+PRESENCE_FALSE_POSITIVE_RATE = 0.01
+PRESENCE_INFO_FIELD = 'NOVEL'
 
-    :param output_dir: Output directory to write VCF to.
-    :type output_dir: str
+# local port and number of concurrently running jobs of the annotation server,
+# how many jobs it accepts before refusing new ones, how many job records it
+# keeps, and where its jobs stage their input VCFs
+SERVER_PORT = 8642
+SERVER_WORKERS = 2
+SERVER_MAX_PENDING = 16
+SERVER_MAX_JOBS = 1000
+SERVER_STAGING_DIR = 'hdfs:///tmp/hail-annotate-jobs/'
 
-    :param use_chr: If True, appends a 'chr' prefic to all CHROM entries if not already present.
-    :type use_chr: bool
+# buffer size of files written through Hail's filesystem (Hail's default is 8 KB)
+HADOOP_WRITE_BUFFER_SIZE = 8 * 1024 * 1024
 
-    :raises pd.errors.ParserError: Input DataFrame is missing required columns.
-    :raises pd.errors.ParserError: Required input columns contain missing data.
-    """    
-    
-    vcfcols = ['CHROM', 'POS', 'ID','REF','ALT'	,'QUAL','FILTER','INFO','FORMAT']
-    
-    # use HDFS for output
-    output_dir = 'hdfs:///tmp/'
+# scratch space for checkpoints of an instrumented run
+CHECKPOINT_DIR = 'hdfs:///tmp/hail-annotate-checkpoints/'
+
+# name of the manifest of completed stages in a run's working directory
+RUN_MANIFEST = 'manifest.json'
 
-    # raise exception if wrong columns are present
-    if False in [i in input_df.columns for i in ['CHROM','POS','REF','ALT']]:
-        raise pd.errors.ParserError("Input dataframe is missing VCF variant info colums (CHROM, POS, REF, ALT)!")
-    
-    # raise exception if input columns have missing data
-    if input_df[['CHROM','POS','REF','ALT']].isnull().any().any():
-        culprits = ', '.join(input_df.columns[input_df.isnull().any()])
-        raise pd.errors.ParserError(('columns ' + culprits + ' contain missing data!'))
-    
-    # convert CHROM column to string
-    input_df.loc[:, 'CHROM'] = input_df.CHROM.astype(str)
-    
-    # format CHROM column
-    if use_chr == True:
-        input_df.loc[np.logical_not(input_df.CHROM.str.contains('chr')), 'CHROM'] = 'chr' + input_df.CHROM
-    else:
-        input_df.loc[(input_df.CHROM.str.contains('chr')), 'CHROM'] = input_df.CHROM.str.replace("chr","")
-        
-    # fill in other required VCF columns
-    newcols = [i for i in ['ID', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] if i not in input_df.columns]
-    
-    # fill NaN in present required columns
-    if not bool(newcols) and input_df[vcfcols].isnull().any().any():
-        for colname in ['ID', 'QUAL', 'FILTER', 'INFO', 'FORMAT']:
-            input_df.loc[:, colname] = input_df[colname].replace(np.nan, '.')
-    
-    for colname in newcols:
-        input_df[colname] = '.'
-        
-    # set correct QUAL, FILTER cols
-    input_df.loc[input_df.QUAL=='.', 'QUAL'] == 100.00
-    input_df.loc[input_df.FILTER=='.', 'FILTER'] == 'PASS'
-    
-    # add example FORMAT and genotype columns
-    input_df['FORMAT'] == 'GT'
-    input_df['GT1'] = '0/1'
-    
-    # order columns
-    input_df = input_df[['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT','GT1']]
-    
-    # drop duplicates
-    input_df = input_df.drop_duplicates()
-    
-    # rename header line
-    input_df.rename(columns={'CHROM':'#CHROM'}, inplace=True)
-    
-    # check for missing values
-    if input_df.isnull().sum().any():
-        print('Missing data in output VCF file!')
-    
-    # set output path, write file
-    output_path = os.path.join(output_dir, "fake_vcf.tmp.vcf")
-    input_df.to_csv(output_path, sep='\t', index=False)
+# manifest listing the live tables of the annotation cache, the number of
+# delta tables kept before they are compacted into one, and how often a
+# conflicting manifest update is retried
+CACHE_LATEST = 'LATEST'
+CACHE_MAX_TABLES = 8
+CACHE_UPDATE_RETRIES = 10
 
-    
-    # inject file format info into metadata    
-    newfile = output_path.replace('.tmp','')
-    command = f"hdfs dfs -cat {output_path.replace('hdfs://','')} | sed -e '1i\##fileformat=VCFv4.2' | hadoop fs -put -f - {newfile.replace('hdfs://','')}"
-    print(command)
-    subprocess.check_output(command, shell=True)
-
-    # clean up tmp file from HDFS
-    command = f"hdfs dfs -rm -R {output_path.replace('hdfs://','')}"
-    print(command)
-    subprocess.check_output(command, shell=True)
-    
-    # return output path for reference
-    return(newfile)
-    
+# type of the 'sources' global of the annotation cache and reduced reference
+SOURCES_DTYPE = 'dict<str, struct{path: str, version: str, fields: str}>'
 
-def add_db_annotations(vcf, db, config):
-    """Annotates input VCF with GnomAD data specified by the 
-    `db` parameter.
+# number of input rows parsed per pandas chunk
+READ_CHUNK_SIZE = 500_000
 
-    :param vcf: VCF file, which has been given all required keys and converted to a Hail table.
-    :type vcf: hail.Table
+# width of the locus bins coalesced into gnomAD read intervals
+INTERVAL_BIN_SIZE = 100_000
 
-    :param db: Key matching a GnomAD database listed within the config.json, either "exomes" or "genomes."
-    :type db: str
+# target input rows per partition when aligning partitions with GnomAD
+ALIGN_ROWS_PER_PARTITION = 500_000
 
-    :param config: path to config.json containing GnomAD database cloud bucket paths.
-    :type config: str
+# region annotated when 'testing' is set without a 'dry-run-region'
+TESTING_REGION = '22'
 
-    :return: Hail Table annotated with 
-    :rtype: hail.Table
-    """    
+# seed of the random sample taken with 'dry-run-fraction'
+DRY_RUN_SEED = 0
+
+# resource planner: rough input bytes per variant row, and the expansion
+# of gzipped inputs
+PLAN_BYTES_PER_VARIANT = 50
+PLAN_GZIP_RATIO = 4
+
+# resource planner: target variants per partition for import and joins
+PLAN_VARIANTS_PER_PARTITION = 250_000
 
-    # set af cutoff for exome and genome frequency (all subpopulations)
-    af_cutoff = config['script-params']['allele-frequency-cutoff']['value']
-                        
-    if db == "exomes":
-        # annotate VCF with exome information
-        ht = hl.read_table(config['gnomad-paths']['exomes']['value'])
-        #logger.debug(f"BRADLOG: Annotating DB type: {db}. Input rows: {vcf.count()}.")
-        vcf = vcf.annotate_rows(efreq=ht[vcf.locus, vcf.alleles].freq.AF[0])
-        #logger.debug(f"BRADLOG: Annotated rows with 'efreq' field. Output rows: {vcf.count()}.")
-        vcf = vcf.annotate_rows(epopmax=ht[vcf.locus, vcf.alleles].popmax.AF[0])
-        #logger.debug(f"BRADLOG: Annotated rows with 'epopmax' field. Output rows: {vcf.count()}.")
-        
-        # fill missing values in efreq, epopmax columns
-        vcf = vcf.annotate_entries(
-            efreq_filled = hl.if_else(
-                hl.is_missing(vcf.efreq),
-                0.0,
-                vcf.efreq
-            ),
-            epopmax_filled = hl.if_else(
-                hl.is_missing(vcf.epopmax),
-                0.0,
-                vcf.epopmax
-            )
-        )
-
-        # drop and rename columns
-        vcf = vcf.drop('efreq', 'epopmax')
-        vcf = vcf.rename({'efreq_filled': 'efreq', 'epopmax_filled': 'epopmax'})
-
-        # use hail aggregators to filter for variants below AF cutoff
-        vcf = vcf.filter_rows(
-            hl.agg.count_where(vcf.efreq < af_cutoff) > 0)
-        #logger.debug(f"BRADLOG: Filtering on allele frequency using 'efreq' field. Output rows: {vcf.count()}.")
-        
-    if db == "genomes":
-        
-        # annotate vcf with genome information
-        ht = hl.read_table(config['gnomad-paths']['genomes']['value'])
-        #logger.debug(f"BRADLOG: Annotating DB type: {db}. Input rows: {vcf.count()}.")
-        vcf = vcf.annotate_rows(gfreq=ht[vcf.locus, vcf.alleles].freq.AF[0])
-        #logger.debug(f"BRADLOG: Annotated rows with 'gfreq' field. Output rows: {vcf.count()}.")
-        vcf = vcf.annotate_rows(gpopmax=ht[vcf.locus, vcf.alleles].popmax.AF[0])
-        #logger.debug(f"BRADLOG: Annotated rows with 'gpopmax' field. Output rows: {vcf.count()}.")
-
-        # fill missing values in efreq, epopmax columns
-        vcf = vcf.annotate_entries(
-            gfreq_filled = hl.if_else(
-                hl.is_missing(vcf.gfreq),
-                0.0,
-                vcf.gfreq
-            ),
-            gpopmax_filled = hl.if_else(
-                hl.is_missing(vcf.gpopmax),
-                0.0,
-                vcf.gpopmax
-            )
-        )
-
-        # drop and rename columns
-        vcf = vcf.drop('gfreq', 'gpopmax')
-        vcf = vcf.rename({'gfreq_filled': 'gfreq', 'gpopmax_filled': 'gpopmax'})
-
-        # use hail aggregators to filter for variants below AF cutoff
-        vcf = vcf.filter_rows(
-            hl.agg.count_where(vcf.gfreq < af_cutoff) > 0)
-        #logger.debug(f"BRADLOG: Filtering on allele frequency using 'gfreq' field. Output rows: {vcf.count()}.")
-
-    if db == "proportion_expressed":
-        
-        # annotate with proportion expressed
-        ht = hl.read_table(config['gnomad-paths']['proportion_expressed']['path'])
-        vcf = vcf.annotate_rows(proportion_expressed=ht[vcf.locus].mean_proportion)
-        
-    return vcf
+# 'spark' config entries that override the planned partition counts;
+# all other entries must be Spark conf keys, e.g. 'spark.executor.memory'
+PLAN_OVERRIDES = ['min-partitions', 'join-partitions']
 
-    
-def vcf_to_mt(input_df, config):
-    """Converts an input VCF with minimum required columns 
-    (CHROM, POS, REF, ALT) to a Hail table.
 
-    :param input_df: Pandas dataframe with minimal required VCF columns
-    :type input_df: pd.DataFrame
+class HailFileSystem:
+    """File operations through Hail's Hadoop filesystem layer, which
+    supports gs://, hdfs:// and file:// paths on a cluster."""
 
-    :param config: Path to config containing tmp directory to use for caching VCF file.
-    :type config: str
+    def open(self, path, mode='r'):
+        # each buffer flush is a py4j call, so stream writes through a large buffer
+        if 'w' in mode:
+            return hl.hadoop_open(path, mode, buffer_size=HADOOP_WRITE_BUFFER_SIZE)
+        return hl.hadoop_open(path, mode)
 
-    :return: VCF converted to hail.Table (function name is a misnomer)
-    :rtype: hail.Table
-    """
+    def exists(self, path):
+        return hl.hadoop_exists(path)
 
-    # check if VCF cols are present in input df
-    hdfs_path = fake_vcf(input_df[["CHROM","POS","REF","ALT"]], use_chr=False)
-        
-    # read matrix table
-    vcf = hl.import_vcf(hdfs_path)
-    
-    # split mutliallelic entries
-    vcf = hl.split_multi(vcf)
-    # NOTE THAT THIS HANDLES the `GT` FIELD ODDLY, SEE DOCS
-    # https://hail.is/docs/0.2/methods/genetics.html#hail.methods.split_multi
+    def ls(self, path):
+        return [{'path': i['path'], 'size_bytes': i['size_bytes'], 'is_dir': i['is_dir']}
+                for i in hl.hadoop_ls(path)]
+
+    def copy(self, src, dest):
+        # hadoop_copy only handles files, so walk directories
+        if hl.hadoop_is_dir(src):
+            for i in self.ls(src):
+                self.copy(i['path'], os.path.join(dest, os.path.basename(i['path'])))
+        else:
+            hl.hadoop_copy(src, dest)
 
-    # if testing, create smaller variant subset
-    if config['script-params']['testing']['value']:
-        vcf = vcf.filter_rows(vcf.locus.contig == '22')
+    def rmtree(self, path):
+        if hl.hadoop_exists(path):
+            hl.current_backend().fs.rmtree(path)
 
-    return vcf
 
+class LocalFileSystem:
+    """File operations on the local filesystem, for file:// or scheme-less
+    paths. Lets pipeline I/O be exercised without a cluster."""
 
-def hail_annotate(input_df, config):
-    """Runs Hail annotation scripts for all input GnomAD databases.
+    @staticmethod
+    def _local(path):
+        return path.replace('file://', '', 1)
 
-    :param input_df: Pandas Dataframe containing minimum required VCF columns (CHROM, POS, REF, ALT)
-    :type input_df: pd.DataFrame
+    def open(self, path, mode='r'):
+        path = self._local(path)
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        return open(path, mode)
 
-    :param output_path: Output path on DataProc instance to use for writing annotated data. 
-    Output data contains epopmax, gpopmax, and proportion_expressed,
-    keyed by variant. Allele frequency > 0.01 is returned as NA.
-    :type output_path: str
+    def exists(self, path):
+        return os.path.exists(self._local(path))
 
-    :param config: Path to config JSON file containing workflow parameters.
-    :type config: str
-    """    
-            
-    vcf = vcf_to_mt(input_df, config)
+    def ls(self, path):
+        path = self._local(path)
+        return [{'path': os.path.join(path, i),
+                 'size_bytes': os.path.getsize(os.path.join(path, i)),
+                 'is_dir': os.path.isdir(os.path.join(path, i))}
+                for i in sorted(os.listdir(path))]
 
-    for db in ['exomes','genomes']:
-        
-        print(f"Adding annotations for: {db}")
-        vcf = add_db_annotations(vcf, db, config)
-        print(f"Done with annotations for: {db}")
+    def copy(self, src, dest):
+        src, dest = self._local(src), self._local(dest)
+        if os.path.isdir(src):
+            shutil.copytree(src, dest, dirs_exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+            shutil.copyfile(src, dest)
 
-    # construct a variant expression
-    vcf = vcf.annotate_rows(variant=vcf.locus.contig + ':' + hl.format('%s', vcf.locus.position) + vcf.alleles[0] + '>' + vcf.alleles[1])
-    
-    # export table to HDFS storage
-    export = vcf.select_entries(vcf.efreq, vcf.epopmax, vcf.gfreq, vcf.gpopmax).entries()
-    output_path = 'hdfs:///tmp/hail-annotate-output.tsv'
-    export.export(output_path)
-    print(f"Wrote annotated VCF to {output_path}.")
+    def rmtree(self, path):
+        shutil.rmtree(self._local(path), ignore_errors=True)
 
 
-def execute_annotation(config_path):
-    """Wrapper which opens config path, reads input VCF, 
-    and launches annotation script.
+class FsspecFileSystem:
+    """File operations through fsspec (e.g. gcsfs for gs:// paths), for
+    code that runs without starting Hail's JVM."""
 
-    :param input_path: Path (on DataProc instance) to input, tab-delimited file with CHROM, POS, REF, ALT columns.
-    :type input_path: str
+    def open(self, path, mode='r'):
+        return fsspec.open(path, mode).open()
 
-    :param output_path: Output path (on DataProc instance) to use for writing output, annotated data.
-    :type output_path: str
+    def exists(self, path):
+        fs, root = fsspec.core.url_to_fs(path)
+        return fs.exists(root)
 
-    :param config_path: Path (on DataProc instance) to config JSON file containing workflow parameters.
-    :type config_path: str
-    """
+    def ls(self, path):
+        fs, root = fsspec.core.url_to_fs(path)
+        return [{'path': fs.unstrip_protocol(i['name']),
+                 'size_bytes': i['size'],
+                 'is_dir': i['type'] == 'directory'}
+                for i in fs.ls(root, detail=True)]
 
-    # import config
-    config = import_config(config_path)
-    print("Imported config.")
+    def copy(self, src, dest):
+        with fsspec.open(src, 'rb') as fsrc, fsspec.open(dest, 'wb') as fdest:
+            shutil.copyfileobj(fsrc, fdest)
 
-    # read VCF as pandas df
-    vcf = read_vcf(config['script-params']['input-vcf']['value'])
+    def rmtree(self, path):
+        fs, root = fsspec.core.url_to_fs(path)
+        if fs.exists(root):
+            fs.rm(root, recursive=True)
 
-    # run annotation script
-    hail_annotate(vcf, config)
 
-    # upload to GCP
-    destination_path = config['script-params']['output-name']['value']
-    upload_to_cloud(destination_path
-                    )
+def get_filesystem(path, jvm=True):
+    """Pick the filesystem implementation for a path.
 
-    print(f"Run completed. Annotated file written to {destination_path}")
+    :param path: gs://, hdfs://, file:// or local path.
+    :type path: str
+    :param jvm: If False, remote paths are handled through fsspec instead of Hail.
+    :type jvm: bool
+    :return: Filesystem able to read and write `path`.
+    :rtype: HailFileSystem, FsspecFileSystem or LocalFileSystem
+    """
 
+    if path.startswith('file://') or '://' not in path:
+        return LocalFileSystem()
+    if not jvm:
+        return FsspecFileSystem()
+    return HailFileSystem()
+
+
+class RunReport:
+    """Record wall time per pipeline stage and row counts for a run, written
+    as JSON next to the output. When `checkpoint_dir` is set, stage outputs
+    are checkpointed there so each timed stage does its own work, and row
+    counts come from a single aggregation over checkpointed data. After
+    `resume_run`, completed checkpoints are listed in a manifest so a rerun
+    can `restore` them instead of repeating their stages. `scratch_dir` holds
+    other intermediate tables of the run, and `cleanup` removes both
+    directories once the output is written."""
+
+    def __init__(self, checkpoint_dir=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.scratch_dir = None
+        self.stages = []
+        self.row_counts = {}
+        self.started = time.time()
+        self._checkpoint_names = set()
+        self.manifest_path = None
+        self.completed = {}
+        self.plan = {}
+
+    def resume_run(self, run_dir, signature):
+        # checkpoints of a named run, kept across reruns with the same inputs
+        self.checkpoint_dir = run_dir
+        self.manifest_path = os.path.join(run_dir, RUN_MANIFEST)
+        fs = get_filesystem(self.manifest_path)
+        if fs.exists(self.manifest_path):
+            with fs.open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest['signature'] == signature:
+                self.completed = manifest['stages']
+                print(f"Resuming run from {run_dir}, completed stages: {', '.join(self.completed) or 'none'}.")
+            else:
+                print(f"Run at {run_dir} was started with different inputs, starting over.")
+        self._signature = signature
+
+    def _next_name(self, name):
+        # keep names unique, e.g. one 'input' checkpoint per batch source
+        base_name, n = name, 1
+        while name in self._checkpoint_names:
+            name = f'{base_name}_{n}'
+            n += 1
+        return name
+
+    def is_complete(self, name):
+        path = self.completed.get(self._next_name(name))
+        return path is not None and get_filesystem(path).exists(os.path.join(path, '_SUCCESS'))
+
+    def restore(self, name):
+        # read a completed checkpoint of a previous attempt, or return None
+        if not self.is_complete(name):
+            return None
+        name = self._next_name(name)
+        self._checkpoint_names.add(name)
+        path = self.completed[name]
+        print(f"Restored stage {name} from {path}.")
+        return hl.read_matrix_table(path) if path.endswith('.mt') else hl.read_table(path)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append({'stage': name, 'seconds': round(time.perf_counter() - start, 3)})
+            print(f"Stage {name} finished in {self.stages[-1]['seconds']}s.")
+
+    def timed(self, iterable, name):
+        # time spent producing items of a lazy iterable, e.g. read_vcf chunks
+        seconds = 0.0
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - start
+            yield item
+        self.stages.append({'stage': name, 'seconds': round(seconds, 3)})
+
+    def checkpoint(self, vcf, name):
+        if self.checkpoint_dir is None:
+            return vcf
+        name = self._next_name(name)
+        self._checkpoint_names.add(name)
+        extension = '.mt' if isinstance(vcf, hl.MatrixTable) else '.ht'
+        path = os.path.join(self.checkpoint_dir, name + extension)
+        vcf = vcf.checkpoint(path, overwrite=True)
+
+        if self.manifest_path is not None:
+            self.completed[name] = path
+            with get_filesystem(self.manifest_path).open(self.manifest_path, 'w') as f:
+                json.dump({'signature': self._signature, 'stages': self.completed}, f, indent=4)
+        return vcf
+
+    def cleanup(self, keep_checkpoints=False):
+        # checkpoints are only needed until the output is written, or until a
+        # failed named run is resumed
+        paths = {self.scratch_dir} if keep_checkpoints else {self.checkpoint_dir, self.scratch_dir}
+        for path in paths - {None}:
+            get_filesystem(path).rmtree(path)
+            print(f"Removed intermediate tables in {path}.")
+
+    def write(self, path, jvm=True):
+        report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                  'total_seconds': round(time.time() - self.started, 3),
+                  'stages': self.stages,
+                  'row_counts': self.row_counts,
+                  'resource_plan': self.plan}
+        with get_filesystem(path, jvm).open(path, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"Wrote run report to {path}.")
+
+
+def find_vcf_header(path):
+    """Locate the CHROM or #CHROM header of a VCF or tab-delimited file by
+    scanning raw lines, stopping as soon as the header is found.
+
+    :param path: Path to VCF (local or any fsspec-supported URL, e.g. gs://)
+    :type path: str
+    :raises pd.errors.ParserError: No header line was found.
+    :return: tuple with column names (leading '#' removed) and the 0-based line number of the header
+    :rtype: tuple
+    """
 
-def upload_to_cloud(destination_path):
-    """Upload annotated file to Google Cloud. Requires "Storage Folder Admin" permission.
+    with fsspec.open(path, 'rb', compression='infer') as f:
+        for line_number, line in enumerate(f):
+            # skip VCF meta-information lines
+            if line.startswith(b'##'):
+                continue
+            if b'CHROM' in line:
+                cols = line.rstrip(b'\r\n').decode().split('\t')
+                cols[0] = cols[0].lstrip('#')
+                return cols, line_number
 
-    :param destination_path: GCP Destination path parsed from Config
-    :type destination_path: str
-    """
+    raise pd.errors.ParserError(f"Could not find a CHROM header in {path}!")
 
-    # perform efficient Hadoop-style Upload
-    command = f"hadoop distcp hdfs:///tmp/hail-annotate-output.tsv {destination_path}"
-    print(command)
-    subprocess.check_output(command, shell=True)
 
-    print(f"Annotated output loaded to {destination_path}.")
+def read_vcf(path, chunksize=READ_CHUNK_SIZE):
+    """Import VCF with support for CHROM or #CHROM header. The body is
+    streamed in chunks, so peak memory is set by `chunksize` rather than
+    the size of the file. All columns are read as strings.
+
+    :param path: GCP path to VCF
+    :type path: str
+    :param chunksize: Number of rows per yielded DataFrame.
+    :type chunksize: int
+    :return: Generator of imported VCF chunks
+    :rtype: generator of pd.DataFrame
+    """
+
+    # find header without parsing the body
+    cols, header_line = find_vcf_header(path)
+
+    # stream rows after the header
+    reader = pd.read_csv(path,
+                         sep='\t',
+                         comment='#',
+                         header=None,
+                         names=cols,
+                         dtype=str,
+                         skiprows=header_line + 1,
+                         chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            yield chunk
+
+
+def is_vcf(input_df):
+    """Return True if input contains minimum VCF columns
+    (CHROM, POS, REF, ALT).
+
+    :return: True if VCF file contains minimum required headers.
+    :rtype: bool
+    """    
+    
+    # VCF cols are missing
+    if not all([i in input_df.columns for i in ["CHROM","POS","REF","ALT"]]):
+        return False
+        
+    else:
+        return True
+
+
+def contig_rank(contigs):
+    """Rank contig names in reference order (1-22, X, Y, MT), with any other
+    contigs after these in name order.
+
+    :param contigs: Contig names without a 'chr' prefix.
+    :type contigs: np.ndarray
+    :return: Integer rank of each contig.
+    :rtype: np.ndarray
+    """
+
+    # rank each distinct contig once, then broadcast back to rows
+    names, inverse = np.unique(contigs, return_inverse=True)
+    order = {contig: i for i, contig in enumerate(CONTIG_ORDER)}
+    ranks = np.array([order.get(name, len(order)) for name in names], dtype=np.int64)
+    unknown = ranks == len(order)
+    ranks[unknown] += np.arange(unknown.sum())
+    return ranks[inverse]
+
+
+def normalize_vcf_rows(input_df, use_chr=True, sites_only=False):
+    """Normalize one DataFrame of variants into VCF body rows in a single
+    vectorized pass: recode the CHROM prefix, check the required columns,
+    sort by contig and position and drop duplicate variants. Any of the
+    'ID', 'QUAL', 'FILTER', 'INFO', 'FORMAT' columns which are not present
+    are filled with '.', and a placeholder genotype column is added.
+
+    :param input_df: Pandas DataFrame with 'CHROM', 'REF', 'POS', 'ALT' columns.
+    :type input_df: pd.DataFrame
+
+    :param use_chr: If True, appends a 'chr' prefic to all CHROM entries if not already present.
+    :type use_chr: bool
+
+    :param sites_only: If True, leaves out the FORMAT and placeholder genotype columns.
+    :type sites_only: bool
+
+    :raises pd.errors.ParserError: Input DataFrame is missing required columns.
+    :raises pd.errors.ParserError: Required input columns contain missing data.
+    :return: Sorted, de-duplicated rows with VCF_COLUMNS (or SITES_COLUMNS) columns.
+    :rtype: pd.DataFrame
+    """
+
+    # raise exception if wrong columns are present
+    if not is_vcf(input_df):
+        raise pd.errors.ParserError("Input dataframe is missing VCF variant info colums (CHROM, POS, REF, ALT)!")
+
+    key = ['CHROM', 'POS', 'REF', 'ALT']
+    arrays = {col: input_df[col].to_numpy() for col in key}
+
+    # raise exception if input columns have missing data
+    missing = [col for col in key if pd.isnull(arrays[col]).any()]
+    if missing:
+        raise pd.errors.ParserError(('columns ' + ', '.join(missing) + ' contain missing data!'))
+
+    output_columns = SITES_COLUMNS if sites_only else VCF_COLUMNS
+    if len(input_df) == 0:
+        return pd.DataFrame(columns=output_columns)
+
+    # recode CHROM prefix
+    contig = np.char.replace(arrays['CHROM'].astype(str), 'chr', '')
+    chrom = np.char.add('chr', contig) if use_chr else contig
+    try:
+        pos = arrays['POS'].astype(np.int64)
+    except ValueError:
+        raise pd.errors.ParserError("column POS contains non-integer positions!")
+    ref = arrays['REF'].astype(str)
+    alt = arrays['ALT'].astype(str)
+
+    # sort by contig, position and alleles, then drop repeats of the previous key
+    order = np.lexsort((alt, ref, pos, contig_rank(contig)))
+    chrom, pos, ref, alt = chrom[order], pos[order], ref[order], alt[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = ((chrom[1:] != chrom[:-1]) | (pos[1:] != pos[:-1])
+                | (ref[1:] != ref[:-1]) | (alt[1:] != alt[:-1]))
+    rows = order[keep]
+
+    # pass through optional columns that are present, filling missing data
+    columns = {'CHROM': chrom[keep], 'POS': pos[keep], 'REF': ref[keep], 'ALT': alt[keep]}
+    for colname in ['ID', 'QUAL', 'FILTER', 'INFO', 'FORMAT']:
+        if colname in input_df.columns:
+            values = input_df[colname].to_numpy()[rows]
+            columns[colname] = np.where(pd.isnull(values), '.', values)
+        else:
+            columns[colname] = '.'
+    columns[FAKE_SAMPLE] = '0/1'
+
+    return pd.DataFrame(columns, columns=output_columns)
+
+
+def fake_vcf(input_df,
+             use_chr=True,
+             output_dir='hdfs:///tmp/',
+             sites_only=False,
+             presence_filter=None):
+    """Spoof a VCF file structure when passed an input DataFrame containing CHROM, REF, POS, ALT columns. 
+    For all columns in 'ID', 'QUAL', 'FILTER', 'INFO', 'FORMAT', adds any columns which are not present.
+    Added columns will be contain empty data. This script will overwrite any existing information in the 
+    VCF header, ie contig information. Input may be a single DataFrame or an iterable of DataFrame chunks
+    (as returned by `read_vcf`), which are normalized and streamed to the output one at a time. Sorting
+    and duplicate removal are within a chunk.
+
+    :param input_df: Pandas DataFrame (or iterable of DataFrames) with 'CHROM', 'REF', 'POS', 'ALT' columns.
+    :type input_df: pd.DataFrame
+
+    :param use_chr: If True, appends a 'chr' prefic to all CHROM entries if not already present.
+    :type use_chr: bool
+
+    :param output_dir: Output directory to write VCF to (HDFS by default).
+    :type output_dir: str
+
+    :param sites_only: If True, writes a sites-only VCF without FORMAT and genotype columns.
+    :type sites_only: bool
+
+    :param presence_filter: Presence filter from `open_presence_filter`. If given, the INFO column
+    flags the alleles the filter rules out (see `novel_alleles`).
+    :type presence_filter: dict
+
+    :raises pd.errors.ParserError: Input DataFrame is missing required columns.
+    :raises pd.errors.ParserError: Required input columns contain missing data.
+    :return: Path to the written VCF.
+    :rtype: str
+    """    
+    
+    if isinstance(input_df, pd.DataFrame):
+        input_df = [input_df]
+
+    # stream metadata, header and each normalized chunk in one write
+    output_path = os.path.join(output_dir, "fake_vcf.vcf")
+    fs = get_filesystem(output_path)
+    with fs.open(output_path, 'w') as f:
+        f.write('##fileformat=VCFv4.2\n')
+        if presence_filter is not None:
+            f.write(f'##INFO=<ID={PRESENCE_INFO_FIELD},Number=A,Type=Integer,'
+                    'Description="1 if the allele is absent from the annotation sources">\n')
+        columns = SITES_COLUMNS if sites_only else VCF_COLUMNS
+        f.write('\t'.join(['#CHROM'] + columns[1:]) + '\n')
+        for chunk in input_df:
+            rows = normalize_vcf_rows(chunk, use_chr=use_chr, sites_only=sites_only)
+            if presence_filter is not None and len(rows):
+                rows['INFO'] = novel_alleles(rows, presence_filter)
+            rows.to_csv(f, sep='\t', index=False, header=False)
+    
+    # return output path for reference
+    return(output_path)
+    
+
+def locus_intervals(vcf, bin_size=INTERVAL_BIN_SIZE):
+    """Summarise the loci covered by an input as a list of locus intervals.
+    Positions are binned per contig and adjacent bins are coalesced, so the
+    aggregation returns at most one entry per bin regardless of input size.
+
+    :param vcf: Input keyed by locus and alleles.
+    :type vcf: hail.MatrixTable or hail.Table
+    :param bin_size: Width (bp) of the bins that are merged into intervals.
+    :type bin_size: int
+    :return: Sorted, non-overlapping intervals covering every input locus.
+    :rtype: list of hail.Interval
+    """
+
+    rows = variant_rows(vcf)
+    rg = rows.locus.dtype.reference_genome
+
+    # collect occupied (contig, bin) pairs
+    bins = rows.aggregate(hl.agg.collect_as_set(
+        hl.tuple([rows.locus.contig, (rows.locus.position - 1) // bin_size])))
+
+    # coalesce runs of adjacent bins into [start, end] ranges per contig
+    ranges = []
+    for contig, idx in sorted(bins, key=lambda x: (rg.contigs.index(x[0]), x[1])):
+        if ranges and ranges[-1][0] == contig and ranges[-1][2] == idx - 1:
+            ranges[-1][2] = idx
+        else:
+            ranges.append([contig, idx, idx])
+
+    intervals = []
+    for contig, first, last in ranges:
+        start = first * bin_size + 1
+        end = min((last + 1) * bin_size, rg.lengths[contig])
+        intervals.append(hl.Interval(hl.Locus(contig, start, reference_genome=rg),
+                                     hl.Locus(contig, end, reference_genome=rg),
+                                     includes_end=True))
+
+    return intervals
+
+
+@functools.lru_cache(maxsize=None)
+def open_reference_table(path):
+    """Open a Hail table once per path and process. Tables are immutable,
+    so jobs of a long-running server share the opened table and its
+    metadata is only read once.
+
+    :param path: Path to a Hail table.
+    :type path: str
+    :return: Table
+    :rtype: hail.Table
+    """
+
+    return hl.read_table(path)
+
+
+def read_reference_table(path, intervals=None, partitions=None):
+    """Read a locus-keyed reference table, restricted to the partitions
+    overlapping `intervals` when they are provided. If `partitions` are
+    given, the table is read with exactly these key ranges as partitions,
+    so it lines up with an input read the same way.
+
+    :param path: Path to a Hail table keyed by locus (and optionally alleles).
+    :type path: str
+    :param intervals: Locus intervals to read, or None to read the whole table.
+    :type intervals: list of hail.Interval
+    :param partitions: Key intervals to use as partitions, from `align_partitions`.
+    :type partitions: list of hail.Interval
+    :return: Reference table
+    :rtype: hail.Table
+    """
+
+    if partitions is not None:
+        # only the key ranges of the partitions are read; _intervals is a
+        # private Hail API, see the hail pin in pyproject.toml
+        return hl.read_table(path, _intervals=partitions)
+
+    ht = open_reference_table(path)
+    if intervals is not None:
+        # filter_intervals directly on a read is pushed down to partition pruning
+        ht = hl.filter_intervals(ht, intervals)
+    return ht
+
+
+def source_field_expr(ht, expr):
+    """Compile a field expression such as 'freq.AF[0]' against the rows of
+    a table. Expressions are chains of field names and integer indices.
+
+    :param ht: Annotation source table.
+    :type ht: hail.Table
+    :param expr: Field expression.
+    :type expr: str
+    :return: Expression over the rows of `ht`.
+    :rtype: hail.Expression
+    """
+
+    value = ht.row
+    for name, index in re.findall(r'([A-Za-z_]\w*)|\[(\d+)\]', expr):
+        value = value[name] if name else value[int(index)]
+    return value
+
+
+def region_contig_recoding():
+    """Map contig names with or without a 'chr' prefix onto the contigs of
+    the default reference genome, e.g. 'chr1' to '1' for GRCh37.
+
+    :return: Contig recoding for `hl.import_bed`.
+    :rtype: dict
+    """
+
+    recoding = {}
+    for contig in hl.default_reference().contigs:
+        if contig.startswith('chr'):
+            recoding[contig[3:]] = contig
+        else:
+            recoding['chr' + contig] = contig
+    if 'MT' in recoding.values():
+        recoding['chrM'] = 'MT'
+    return recoding
+
+
+def read_region_track(path):
+    """Import a BED file as an interval-keyed table. Contig names are recoded
+    to the default reference genome, and intervals on unknown contigs are
+    skipped.
+
+    :param path: Path to a BED file (optionally gzipped).
+    :type path: str
+    :return: Table keyed by `interval`, with a `target` field for BED files with a name column.
+    :rtype: hail.Table
+    """
+
+    return hl.import_bed(path,
+                         reference_genome=hl.default_reference(),
+                         contig_recoding=region_contig_recoding(),
+                         skip_invalid_intervals=True)
+
+
+def read_source(source, intervals=None, partitions=None):
+    """Read an annotation source projected down to its declared fields, in
+    one select, so no other fields are read from storage.
+
+    :param source: Annotation source, as returned by `annotation_sources`.
+    :type source: dict
+    :param intervals: Locus intervals to read, or None to read the whole table.
+    :type intervals: list of hail.Interval
+    :param partitions: Key intervals to use as partitions, from `align_partitions`.
+    :type partitions: list of hail.Interval
+    :return: Table keyed by locus (and alleles) with one field per output column.
+    :rtype: hail.Table
+    """
+
+    if source['key'] == 'interval':
+        # region tracks are small, so they are read whole
+        ht = read_region_track(source['path'])
+        return ht.select(**{column: source_field_expr(ht, field['expr'])
+                            for column, field in source['fields'].items()
+                            if field['expr'] not in REGION_EXPRS})
+
+    if source['key'] == 'locus' and partitions is not None:
+        # locus-keyed tables cannot be read with (locus, alleles) partitions
+        intervals = [hl.Interval(i.start.locus, i.end.locus, includes_start=True, includes_end=True)
+                     for i in partitions]
+        partitions = None
+
+    ht = read_reference_table(source['path'], intervals, partitions)
+    if source['key'] == 'locus' and list(ht.key) != ['locus']:
+        ht = ht.key_by('locus')
+
+    return ht.select(**{column: source_field_expr(ht, field['expr'])
+                        for column, field in source['fields'].items()})
+
+
+def source_fields(hit, source):
+    """Build the output fields of one annotation source, filling missing
+    values with each field's default.
+
+    :param hit: Row of `read_source` joined to the input, or array of rows for region tracks.
+    :type hit: hail.StructExpression or hail.ArrayExpression
+    :param source: Annotation source, as returned by `annotation_sources`.
+    :type source: dict
+    :return: Mapping of output column to expression.
+    :rtype: dict
+    """
+
+    if source['key'] == 'interval':
+        return region_fields(hit, source)
+
+    return {column: hit[column] if field['default'] is None else hl.or_else(hit[column], field['default'])
+            for column, field in source['fields'].items()}
+
+
+def region_fields(hits, source):
+    """Build the output fields of a region track from every region
+    overlapping a variant. 'overlaps' gives a flag, 'count' the number of
+    regions, and any other field the distinct values across the regions,
+    comma-separated (or the field's default if there are none).
+
+    :param hits: Array of overlapping `read_source` rows.
+    :type hits: hail.ArrayExpression
+    :param source: Annotation source with key type 'interval'.
+    :type source: dict
+    :return: Mapping of output column to expression.
+    :rtype: dict
+    """
+
+    n_hits = hl.or_else(hl.len(hits), 0)
+    fields = {}
+    for column, field in source['fields'].items():
+        if field['expr'] == 'overlaps':
+            fields[column] = n_hits > 0
+        elif field['expr'] == 'count':
+            fields[column] = n_hits
+        else:
+            values = hl.delimit(hl.sorted(hl.array(hl.set(hits.map(lambda region: hl.str(region[column]))))), ',')
+            values = hl.or_missing(n_hits > 0, values)
+            fields[column] = values if field['default'] is None else hl.or_else(values, hl.str(field['default']))
+    return fields
+
+
+def source_lookup(ht, vcf, source):
+    """Join an annotation source to an input. Region tracks are joined by
+    locus-in-interval and return every overlapping region.
+
+    :param ht: Annotation source table, from `read_source`.
+    :type ht: hail.Table
+    :param vcf: Input keyed by locus and alleles.
+    :type vcf: hail.MatrixTable or hail.Table
+    :param source: Annotation source, as returned by `annotation_sources`.
+    :type source: dict
+    :return: Matching source row, or array of rows for region tracks.
+    :rtype: hail.Expression
+    """
+
+    if source['key'] == 'interval':
+        return ht.index(vcf.locus, all_matches=True)
+    if source['key'] == 'locus':
+        return ht[vcf.locus]
+    return ht[vcf.row_key if isinstance(vcf, hl.MatrixTable) else vcf.key]
+
+
+def annotation_fields(config):
+    """List the output columns of every annotation source, in output order.
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :return: Output column names.
+    :rtype: list
+    """
+
+    return [column for source in annotation_sources(config).values() for column in source['fields']]
+
+
+def filter_frequency(vcf, source, config):
+    """Keep variants with every af-filter field of `source` below the
+    configured cutoff.
+
+    :param vcf: Input annotated with `source_fields` for `source`.
+    :type vcf: hail.MatrixTable or hail.Table
+    :param source: Annotation source, as returned by `annotation_sources`.
+    :type source: dict
+    :param config: Loaded config.json file.
+    :type config: dict
+    :return: Filtered input.
+    :rtype: hail.MatrixTable or hail.Table
+    """
+
+    # set af cutoff for every filtered field (all subpopulations)
+    af_cutoff = config['script-params']['allele-frequency-cutoff']['value']
+    for column, field in source['fields'].items():
+        if not field['af-filter']:
+            continue
+        keep = vcf[column] < af_cutoff
+
+        # frequencies are per-variant, so filter rows without aggregating entries
+        if isinstance(vcf, hl.MatrixTable):
+            vcf = vcf.filter_rows(keep)
+        else:
+            vcf = vcf.filter(keep)
+    return vcf
+
+
+def add_db_annotations(vcf, db, config, intervals=None, apply_filter=True, partitions=None):
+    """Annotates input VCF with the fields of the annotation source named by
+    the `db` parameter.
+
+    :param vcf: VCF file, which has been given all required keys and converted to a Hail table.
+    :type vcf: hail.MatrixTable or hail.Table
+
+    :param db: Name of an annotation source, e.g. "exomes" or "genomes" by default.
+    :type db: str
+
+    :param config: Loaded config.json file.
+    :type config: dict
+
+    :param intervals: Locus intervals covered by `vcf`; only matching source partitions are read.
+    :type intervals: list of hail.Interval
+
+    :param apply_filter: If True, removes variants at or above the allele frequency cutoff.
+    :type apply_filter: bool
+
+    :param partitions: Partition key ranges of `vcf`, from `align_partitions`. The source is read with the
+    same partitions so the join runs partition by partition.
+    :type partitions: list of hail.Interval
+
+    :return: Input annotated with the source's output columns.
+    :rtype: hail.MatrixTable or hail.Table
+    """
+
+    source = annotation_sources(config)[db]
+    ht = read_source(source, intervals, partitions)
+
+    # variants a presence filter ruled out skip the join and take the defaults
+    if source['key'] == 'locus-alleles' and 'novel' in vcf.row:
+        novel = vcf.filter_rows(vcf.novel) if isinstance(vcf, hl.MatrixTable) else vcf.filter(vcf.novel)
+        vcf = vcf.filter_rows(~vcf.novel) if isinstance(vcf, hl.MatrixTable) else vcf.filter(~vcf.novel)
+        absent = source_fields(hl.missing(ht.row_value.dtype), source)
+    else:
+        novel = None
+
+    fields = source_fields(source_lookup(ht, vcf, source), source)
+
+    if isinstance(vcf, hl.MatrixTable):
+        vcf = vcf.annotate_rows(**fields)
+        if novel is not None:
+            vcf = vcf.union_rows(novel.annotate_rows(**absent))
+    else:
+        vcf = vcf.annotate(**fields)
+        if novel is not None:
+            vcf = vcf.union(novel.annotate(**absent))
+
+    if apply_filter:
+        vcf = filter_frequency(vcf, source, config)
+
+    return vcf
+
+
+def annotate_variant_table(ht, config):
+    """Annotate a table of variants with the output columns of every
+    annotation source, reading only the source partitions the variants overlap.
+
+    :param ht: Table keyed by locus and alleles.
+    :type ht: hail.Table
+    :param config: Loaded config.json file.
+    :type config: dict
+    :return: `ht` annotated with `annotation_fields` (not filtered on allele frequency).
+    :rtype: hail.Table
+    """
+
+    intervals = locus_intervals(ht)
+    for db in annotation_sources(config):
+        ht = add_db_annotations(ht, db, config, intervals, apply_filter=False)
+    return ht
+
+
+def gnomad_version(path):
+    """Parse a release version (e.g. '2.1.1') from a GnomAD table path.
+
+    :param path: Path to a GnomAD table.
+    :type path: str
+    :return: Version string, or None if the path does not contain one.
+    :rtype: str
+    """
+
+    match = re.search(r'(\d+\.\d+(?:\.\d+)*)', path)
+    return match.group(1) if match else None
+
+
+def cache_sources(sources):
+    """Describe the annotation sources that derived tables (the annotation
+    cache or a reduced reference) are built from.
+
+    :param sources: Annotation sources, as returned by `annotation_sources`.
+    :type sources: dict
+    :return: Mapping of source name to its path, version and field declarations.
+    :rtype: dict
+    """
+
+    return {name: {'path': source['path'],
+                   'version': gnomad_version(source['path']),
+                   'fields': json.dumps({'key': source['key'], 'fields': source['fields']}, sort_keys=True)}
+            for name, source in sources.items()}
+
+
+def read_cache_manifest(cache_dir):
+    """Read the manifest of an annotation cache. The manifest lists the live
+    cache tables, and the tables retired by the last compaction, which are
+    kept until the next one so runs still reading them are not broken. A
+    LATEST file holding a single generation number, as written by earlier
+    versions, is read as one live table.
+
+    :param cache_dir: gs:// directory holding the annotation cache.
+    :type cache_dir: str
+    :return: tuple with the manifest and its version, for `update_cache_manifest`
+    :rtype: tuple
+    """
+
+    text, version = get_storage_backend().read_versioned(os.path.join(cache_dir, CACHE_LATEST))
+    if text is None:
+        return {'tables': [], 'retired': []}, version
+    if text.strip().isdigit():
+        return {'tables': [f'annotations.{int(text)}.ht'], 'retired': []}, version
+    return json.loads(text), version
+
+
+def update_cache_manifest(cache_dir, update):
+    """Apply `update` to the cache manifest as a compare-and-swap, rereading
+    and retrying when another run changed the manifest in between.
+
+    :param cache_dir: gs:// directory holding the annotation cache.
+    :type cache_dir: str
+    :param update: Function from the current manifest to the new manifest.
+    :type update: function
+    :raises Exception: The manifest kept changing for CACHE_UPDATE_RETRIES attempts.
+    :return: tuple with the replaced and the new manifest
+    :rtype: tuple
+    """
+
+    path = os.path.join(cache_dir, CACHE_LATEST)
+    for attempt in range(CACHE_UPDATE_RETRIES):
+        manifest, version = read_cache_manifest(cache_dir)
+        new_manifest = update(copy.deepcopy(manifest))
+        if get_storage_backend().write_if_version(path, json.dumps(new_manifest, indent=4), version):
+            return manifest, new_manifest
+        print(f"Annotation cache manifest at {path} changed during the update, retrying.")
+    raise Exception(f"Could not update annotation cache manifest {path} after {CACHE_UPDATE_RETRIES} attempts!")
+
+
+def read_annotation_cache(cache_dir, config):
+    """Open the live tables of the annotation cache as one table. A cache
+    built from different annotation sources than the current config is
+    ignored.
+
+    :param cache_dir: gs:// directory holding cache tables and the LATEST manifest.
+    :type cache_dir: str
+    :param config: Loaded config.json file.
+    :type config: dict
+    :return: tuple with the cached table (or None) and the list of live table names it was read from
+    :rtype: tuple
+    """
+
+    manifest, _ = read_cache_manifest(cache_dir)
+    if not manifest['tables']:
+        print(f"No annotation cache found at {cache_dir}.")
+        return None, []
+
+    tables = [hl.read_table(os.path.join(cache_dir, name)) for name in manifest['tables']]
+    cached_sources = {db: dict(source) for db, source in hl.eval(tables[0].globals.sources).items()}
+    if cached_sources != cache_sources(annotation_sources(config)):
+        print(f"Annotation cache at {cache_dir} was built from different annotation sources, ignoring it.")
+        return None, []
+
+    return tables[0].union(*tables[1:]), manifest['tables']
+
+
+def compact_annotation_cache(cache_dir, names):
+    """Merge cache tables into one table and swap it into the manifest.
+    Tables retired by the previous compaction are deleted; the merged ones
+    are retired and deleted at the next compaction.
+
+    :param cache_dir: gs:// directory holding the annotation cache.
+    :type cache_dir: str
+    :param names: Names of the live tables to merge.
+    :type names: list
+    """
+
+    tables = [hl.read_table(os.path.join(cache_dir, name)) for name in names]
+    name = f'annotations.{uuid.uuid4().hex[:12]}.ht'
+    tables[0].union(*tables[1:]).distinct().write(os.path.join(cache_dir, name), overwrite=True)
+
+    # keep tables added by other runs since the merged ones were listed
+    def swap(manifest):
+        return {'tables': [name] + [i for i in manifest['tables'] if i not in names],
+                'retired': names}
+
+    old_manifest, _ = update_cache_manifest(cache_dir, swap)
+    for retired in old_manifest['retired']:
+        get_storage_backend().delete_prefix(os.path.join(cache_dir, retired))
+    print(f"Compacted {len(names)} annotation cache tables into {name}.")
+
+
+def annotate_from_cache(vcf, config, cache_dir):
+    """Annotate input variants through a persistent (locus, alleles) cache of
+    annotation source fields. Only variants missing from the cache are joined
+    against the sources. Their results are written as a new delta table,
+    which is added to the cache manifest; once the cache holds more than
+    CACHE_MAX_TABLES tables they are compacted into one.
+
+    :param vcf: Split input variants.
+    :type vcf: hail.MatrixTable or hail.Table
+    :param config: Loaded config.json file.
+    :type config: dict
+    :param cache_dir: gs:// directory holding the annotation cache.
+    :type cache_dir: str
+    :return: Input annotated with `annotation_fields` (not yet filtered on allele frequency).
+    :rtype: hail.MatrixTable or hail.Table
+    """
+
+    cache, names = read_annotation_cache(cache_dir, config)
+
+    # variants not seen by previous runs
+    rows = variant_rows(vcf)
+    delta = rows.select().distinct()
+    if cache is not None:
+        delta = delta.anti_join(cache)
+    delta = annotate_variant_table(delta, config).select(*annotation_fields(config))
+    delta = delta.select_globals(sources=hl.literal(
+        cache_sources(annotation_sources(config)), dtype=SOURCES_DTYPE))
+
+    # write only the new results, and skip the manifest when there are none
+    name = f'annotations.{uuid.uuid4().hex[:12]}.ht'
+    delta_path = os.path.join(cache_dir, name)
+    delta.write(delta_path, overwrite=True)
+    delta = hl.read_table(delta_path)
+    if cache is not None and delta.count() == 0:
+        get_storage_backend().delete_prefix(delta_path)
+        print("All input variants were cached, not adding a cache table.")
+        annotations = cache
+    else:
+        # a cache built from other sources is replaced rather than extended
+        def add(manifest):
+            if cache is None:
+                return {'tables': [name], 'retired': manifest['retired'] + manifest['tables']}
+            return {'tables': manifest['tables'] + [name], 'retired': manifest['retired']}
+
+        _, manifest = update_cache_manifest(cache_dir, add)
+        print(f"Added {delta.count()} variants to the annotation cache in {delta_path}.")
+        annotations = delta if cache is None else cache.union(delta)
+
+        if len(manifest['tables']) > CACHE_MAX_TABLES:
+            compact_annotation_cache(cache_dir, manifest['tables'])
+
+    if isinstance(vcf, hl.MatrixTable):
+        return vcf.annotate_rows(**annotations[vcf.row_key])
+    return vcf.annotate(**annotations[vcf.key])
+
+
+def build_reduced_reference(config, output_path, n_partitions=None):
+    """Write a compact GnomAD reference holding only the fields used for
+    annotation. The exome and genome tables from 'gnomad-paths' are projected
+    to efreq/epopmax and gfreq/gpopmax and outer-joined into a single table
+    keyed by locus and alleles. Point 'reduced-reference' under 'gnomad-paths'
+    at the output to use it for annotation.
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :param output_path: Path to write the reduced Hail table to.
+    :type output_path: str
+    :param n_partitions: Number of partitions to write, or None to keep the joined partitioning.
+    :type n_partitions: int
+    """
+
+    # read full GnomAD tables, not an existing reduced reference
+    sources = gnomad_sources(config)
+    tables = [read_source(source) for source in sources.values()]
+
+    ht = tables[0].join(tables[1], how='outer')
+    ht = ht.select_globals(sources=hl.literal(cache_sources(sources), dtype=SOURCES_DTYPE))
+
+    if n_partitions is not None:
+        ht = ht.repartition(n_partitions)
+
+    ht.write(output_path, overwrite=True)
+    print(f"Wrote reduced GnomAD reference to {output_path}.")
+
+
+def presence_keys(contig, pos, ref, alt):
+    """Hash biallelic variants to the 64-bit keys of a presence filter.
+
+    :param contig: Contigs, without 'chr' prefix.
+    :type contig: np.ndarray
+    :param pos: Positions.
+    :type pos: np.ndarray
+    :param ref: Reference alleles.
+    :type ref: np.ndarray
+    :param alt: Alternate alleles.
+    :type alt: np.ndarray
+    :return: uint64 keys.
+    :rtype: np.ndarray
+    """
+
+    variants = (pd.Series(np.asarray(contig), dtype=object) + ':' + pd.Series(np.asarray(pos)).astype(str)
+                + ':' + pd.Series(np.asarray(ref), dtype=object) + ':' + pd.Series(np.asarray(alt), dtype=object))
+    return pd.util.hash_array(variants.to_numpy(dtype=object))
+
+
+def presence_bits(keys, n_bits, n_hashes):
+    """Bit positions of keys in a Bloom filter, by double hashing the two
+    32-bit halves of each key.
+
+    :param keys: Keys from `presence_keys`.
+    :type keys: np.ndarray
+    :param n_bits: Size of the filter in bits.
+    :type n_bits: int
+    :param n_hashes: Number of bits set per key.
+    :type n_hashes: int
+    :return: One array of bit positions per hash.
+    :rtype: list
+    """
+
+    low = keys & np.uint64(0xFFFFFFFF)
+    high = (keys >> np.uint64(32)) | np.uint64(1)
+    return [(low + np.uint64(i) * high) % np.uint64(n_bits) for i in range(n_hashes)]
+
+
+def set_presence_bits(bits, keys, n_bits, n_hashes):
+    """Add keys to a Bloom filter in place.
+
+    :param bits: Filter bytes, with bit i stored in byte i // 8.
+    :type bits: np.ndarray
+    :param keys: Keys from `presence_keys`.
+    :type keys: np.ndarray
+    :param n_bits: Size of the filter in bits.
+    :type n_bits: int
+    :param n_hashes: Number of bits set per key.
+    :type n_hashes: int
+    """
+
+    for positions in presence_bits(keys, n_bits, n_hashes):
+        np.bitwise_or.at(bits, positions >> np.uint64(3),
+                         np.left_shift(np.uint64(1), positions & np.uint64(7)).astype(np.uint8))
+
+
+def build_presence_filter(config, output_path, false_positive_rate=PRESENCE_FALSE_POSITIVE_RATE):
+    """Write a Bloom filter over the (locus, alleles) keys of every
+    locus-alleles annotation source, serialized as a .npz file. Variants the
+    filter rules out are certainly absent from those sources, so they can
+    skip the joins (see `add_db_annotations`).
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :param output_path: Local or gs:// path of the .npz file.
+    :type output_path: str
+    :param false_positive_rate: Target rate of absent variants the filter lets through.
+    :type false_positive_rate: float
+    :raises Exception: No annotation source is keyed by locus and alleles.
+    """
+
+    sources = {name: source for name, source in annotation_sources(config).items()
+               if source['key'] == 'locus-alleles'}
+    if not sources:
+        raise Exception("A presence filter needs at least one locus-alleles annotation source!")
+
+    tables = [read_source(source).select() for source in sources.values()]
+    ht = tables[0].union(*tables[1:])
+    ht = ht.filter(hl.len(ht.alleles) == 2)
+
+    # size the filter for the target false positive rate
+    n_keys = max(ht.count(), 1)
+    n_bits = int(np.ceil(-n_keys * np.log(false_positive_rate) / np.log(2) ** 2))
+    n_hashes = max(1, int(round(n_bits / n_keys * np.log(2))))
+    bits = np.zeros((n_bits + 7) // 8, dtype=np.uint8)
+    print(f"Building a presence filter of {n_bits} bits and {n_hashes} hashes over {n_keys} variants.")
+
+    rg = ht.locus.dtype.reference_genome
+    for contig in rg.contigs:
+        part = hl.filter_intervals(ht, [hl.parse_locus_interval(contig, reference_genome=rg)])
+        df = part.key_by().select(pos=part.locus.position, ref=part.alleles[0], alt=part.alleles[1]).to_pandas()
+        if df.empty:
+            continue
+
+        keys = presence_keys(np.full(len(df), contig.replace('chr', ''), dtype=object),
+                             df.pos.to_numpy(), df.ref.to_numpy(), df.alt.to_numpy())
+        set_presence_bits(bits, keys, n_bits, n_hashes)
+        print(f"Added {len(df)} variants on contig {contig} to the presence filter.")
+
+    with fsspec.open(output_path, 'wb') as f:
+        np.savez(f, bits=bits, n_bits=n_bits, n_hashes=n_hashes,
+                 sources=json.dumps(cache_sources(sources), sort_keys=True))
+    print(f"Wrote presence filter to {output_path}.")
+
+
+@functools.lru_cache(maxsize=None)
+def open_presence_filter(path):
+    """Load a presence filter written by `build_presence_filter`.
+
+    :param path: Local or gs:// path of the .npz file.
+    :type path: str
+    :return: Filter with 'bits', 'n_bits', 'n_hashes' and 'sources' entries.
+    :rtype: dict
+    """
+
+    with fsspec.open(path, 'rb') as f:
+        data = dict(np.load(f))
+    return {'bits': data['bits'],
+            'n_bits': int(data['n_bits']),
+            'n_hashes': int(data['n_hashes']),
+            'sources': json.loads(str(data['sources']))}
+
+
+def novel_alleles(rows, presence_filter):
+    """Flag each alternate allele of normalized VCF rows that a presence
+    filter rules out. Alleles are trimmed as `min_rep` does, so the keys
+    match the split, biallelic variants of the annotation sources.
+
+    :param rows: Rows from `normalize_vcf_rows`.
+    :type rows: pd.DataFrame
+    :param presence_filter: Filter from `open_presence_filter`.
+    :type presence_filter: dict
+    :return: INFO values such as 'NOVEL=1,0', one per row.
+    :rtype: np.ndarray
+    """
+
+    alleles = rows[['CHROM', 'POS', 'REF']].assign(ALT=rows.ALT.str.split(',')).reset_index(drop=True)
+    alleles = alleles.explode('ALT').rename_axis('row').reset_index()
+    pos, ref, alt = min_rep(alleles.POS.astype(np.int64), alleles.REF.astype(str), alleles.ALT.astype(str))
+
+    keys = presence_keys(alleles.CHROM.str.replace('chr', '').to_numpy(), pos.to_numpy(),
+                         ref.to_numpy(), alt.to_numpy())
+    present = np.ones(len(keys), dtype=bool)
+    for positions in presence_bits(keys, presence_filter['n_bits'], presence_filter['n_hashes']):
+        byte = presence_filter['bits'][positions >> np.uint64(3)]
+        present &= (byte >> (positions & np.uint64(7)).astype(np.uint8)) & 1 == 1
+
+    flags = pd.Series(np.where(present, '0', '1'), index=alleles.row).groupby(level=0).agg(','.join)
+    return (f'{PRESENCE_INFO_FIELD}=' + flags).to_numpy()
+
+
+def split_variants(vcf):
+    """Split multiallelic variants. Dry-run restrictions (see `dry_run_settings`)
+    are applied earlier, during ingestion.
+
+    :param vcf: Imported input variants.
+    :type vcf: hail.MatrixTable or hail.Table
+    :return: Biallelic input variants.
+    :rtype: hail.MatrixTable or hail.Table
+    """
+
+    # split mutliallelic entries (or rows, for sites-only input)
+    vcf = hl.split_multi(vcf)
+    # NOTE THAT THIS HANDLES the `GT` FIELD ODDLY, SEE DOCS
+    # https://hail.is/docs/0.2/methods/genetics.html#hail.methods.split_multi
+
+    return vcf
+
+
+def mark_novel(vcf):
+    """Move the per-allele presence filter flags staged in INFO by
+    `fake_vcf` to a boolean `novel` row field of the split variants, leaving
+    INFO as it would be without the filter.
+
+    :param vcf: Split input variants.
+    :type vcf: hail.MatrixTable or hail.Table
+    :return: Input with a `novel` row field, if INFO carries presence flags.
+    :rtype: hail.MatrixTable or hail.Table
+    """
+
+    if PRESENCE_INFO_FIELD not in vcf.info:
+        return vcf
+
+    fields = {'novel': vcf.info[PRESENCE_INFO_FIELD][vcf.a_index - 1] == 1,
+              'info': vcf.info.drop(PRESENCE_INFO_FIELD)}
+    if isinstance(vcf, hl.MatrixTable):
+        return vcf.annotate_rows(**fields)
+    return vcf.annotate(**fields)
+
+
+def parse_region(region):
+    """Parse a region such as '22', 'chr22' or '22:16000000-17000000'.
+
+    :param region: Contig, optionally followed by a 1-based, inclusive position range.
+    :type region: str
+    :raises Exception: Region is not in the expected format.
+    :return: tuple with the contig (without 'chr' prefix), start and end (None if not given)
+    :rtype: tuple
+    """
+
+    match = re.match(r'^(?:chr)?([A-Za-z0-9_.]+)(?::(\d+)-(\d+))?$', region.replace(',', ''))
+    if match is None:
+        raise Exception(f"Region {region} is invalid! Expecting e.g. '22' or '22:16000000-17000000'.")
+    contig, start, end = match.groups()
+    return contig, int(start) if start else None, int(end) if end else None
+
+
+def dry_run_settings(config):
+    """Return the dry-run restrictions of a config. 'testing' is shorthand
+    for a dry run over TESTING_REGION.
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :return: tuple with the parsed region (or None) and sampling fraction (or None)
+    :rtype: tuple
+    """
+
+    region = get_param(config, 'dry-run-region')
+    if region is None and config['script-params']['testing']['value']:
+        region = TESTING_REGION
+    fraction = get_param(config, 'dry-run-fraction')
+    if fraction is not None and not 0 < fraction <= 1:
+        raise Exception(f"dry-run-fraction {fraction} must be in (0, 1]!")
+    return (parse_region(region) if region is not None else None), fraction
+
+
+def restrict_rows(input_df, region=None, fraction=None, rng=None):
+    """Keep the rows of an input chunk inside `region` and a random
+    `fraction` of them, before they are normalized and staged.
+
+    :param input_df: Input chunk with CHROM and POS columns.
+    :type input_df: pd.DataFrame
+    :param region: Parsed region from `parse_region`, or None.
+    :type region: tuple
+    :param fraction: Fraction of rows to keep, or None.
+    :type fraction: float
+    :param rng: Random generator for sampling.
+    :type rng: np.random.Generator
+    :return: Restricted chunk.
+    :rtype: pd.DataFrame
+    """
+
+    keep = np.ones(len(input_df), dtype=bool)
+    if region is not None:
+        contig, start, end = region
+        keep &= np.char.replace(input_df.CHROM.to_numpy().astype(str), 'chr', '') == contig
+        if start is not None:
+            pos = pd.to_numeric(input_df.POS, errors='coerce').to_numpy()
+            keep &= (pos >= start) & (pos <= end)
+    if fraction is not None:
+        keep &= rng.random(len(input_df)) < fraction
+    return input_df[keep]
+
+
+def vcf_to_mt(input_df, config, report=None, min_partitions=None, staging_dir='hdfs:///tmp/'):
+    """Converts an input VCF with minimum required columns 
+    (CHROM, POS, REF, ALT) to a Hail table.
+
+    :param input_df: Pandas dataframe (or iterable of chunks) with minimal required VCF columns
+    :type input_df: pd.DataFrame
+
+    :param config: Path to config containing tmp directory to use for caching VCF file.
+    :type config: str
+
+    :param report: Run report recording stage timings.
+    :type report: RunReport
+
+    :param min_partitions: Minimum number of partitions to import into, from `plan_resources`.
+    :type min_partitions: int
+
+    :param staging_dir: Directory to stage the formatted VCF in (HDFS by default).
+    :type staging_dir: str
+
+    :return: VCF converted to a hail.MatrixTable, or a hail.Table if 'sites-only' is set.
+    :rtype: hail.MatrixTable or hail.Table
+    """
+
+    report = report if report is not None else RunReport()
+    if isinstance(input_df, pd.DataFrame):
+        input_df = [input_df]
+
+    # check if VCF cols are present in input df (includes time streaming read_vcf chunks)
+    with report.stage('fake_vcf'):
+        chunks = report.timed(input_df, 'read_vcf')
+
+        # drop rows outside a dry run before they are formatted or staged
+        region, fraction = dry_run_settings(config)
+        if region is not None or fraction is not None:
+            rng = np.random.default_rng(DRY_RUN_SEED)
+            chunks = (restrict_rows(chunk, region, fraction, rng) for chunk in chunks)
+
+        # flag alleles absent from the sources while rows pass through the driver
+        presence_filter = None
+        if get_param(config, 'presence-filter') is not None and get_param(config, 'annotation-cache') is None:
+            presence_filter = open_presence_filter(get_param(config, 'presence-filter'))
+            sources = {name: source for name, source in annotation_sources(config).items()
+                       if source['key'] == 'locus-alleles'}
+            if presence_filter['sources'] != json.loads(json.dumps(cache_sources(sources), sort_keys=True)):
+                raise Exception("Presence filter was built from different annotation sources; "
+                                "rebuild it with --build-presence-filter.")
+
+        sites_only = get_param(config, 'sites-only', True)
+        hdfs_path = fake_vcf((chunk[["CHROM","POS","REF","ALT"]] for chunk in chunks), use_chr=False,
+                             output_dir=staging_dir, sites_only=sites_only, presence_filter=presence_filter)
+        
+    # read matrix table (or sites table), removing duplicates that span input chunks
+    with report.stage('vcf_to_mt'):
+        if sites_only:
+            vcf = hl.import_vcf(hdfs_path, min_partitions=min_partitions, drop_samples=True).rows()
+            vcf = vcf.distinct()
+        else:
+            vcf = hl.import_vcf(hdfs_path, min_partitions=min_partitions)
+            vcf = vcf.distinct_by_row()
+        vcf = report.checkpoint(mark_novel(split_variants(vcf)), 'input')
+
+    return vcf
+
+
+def import_vcf_native(path, use_chr=False, min_partitions=None, region=None, fraction=None, sites_only=False):
+    """Import a VCF or tab-delimited variant file directly into Hail, without
+    staging it through pandas or HDFS. The header must be the first line that
+    does not start with '##', and may be written as CHROM or #CHROM. Files
+    ending in .gz are read as block-gzipped.
+
+    Contig recoding, missing-value checks and de-duplication all run as
+    distributed Hail operations. The result mirrors the structure produced by
+    `fake_vcf` and `hl.import_vcf`: one placeholder sample with a 0/1 call.
+
+    :param path: Path to input file with CHROM, POS, REF, ALT columns.
+    :type path: str
+    :param use_chr: If True, adds a 'chr' prefix to CHROM entries, otherwise strips it.
+    :type use_chr: bool
+    :param min_partitions: Minimum number of partitions to import into, from `plan_resources`.
+    :type min_partitions: int
+    :param region: Parsed dry-run region from `parse_region`; other rows are dropped before de-duplication.
+    :type region: tuple
+    :param fraction: Dry-run fraction of rows to keep at random.
+    :type fraction: float
+    :param sites_only: If True, returns the rows as a Table without the placeholder sample.
+    :type sites_only: bool
+    :raises pd.errors.ParserError: Input file is missing required columns.
+    :return: Input variants keyed by locus and alleles.
+    :rtype: hail.MatrixTable or hail.Table
+    """
+
+    ht = hl.import_table(path,
+                         delimiter='\t',
+                         comment='^##',
+                         missing=['', 'NA'],
+                         force_bgz=path.endswith('.gz'),
+                         min_partitions=min_partitions)
+    if '#CHROM' in ht.row:
+        ht = ht.rename({'#CHROM': 'CHROM'})
+
+    # raise exception if wrong columns are present
+    if not all([i in ht.row for i in ['CHROM', 'POS', 'REF', 'ALT']]):
+        raise pd.errors.ParserError("Input file is missing VCF variant info colums (CHROM, POS, REF, ALT)!")
+
+    # fail the job if any required field is missing
+    required = {i: hl.case().when(hl.is_defined(ht[i]), ht[i])
+                            .or_error(f'column {i} contains missing data!')
+                for i in ['CHROM', 'POS', 'REF', 'ALT']}
+
+    # format CHROM column
+    if use_chr == True:
+        contig = hl.if_else(required['CHROM'].contains('chr'),
+                            required['CHROM'],
+                            'chr' + required['CHROM'])
+    else:
+        contig = required['CHROM'].replace('chr', '')
+
+    # restrict a dry run right after contig recoding, so either prefix matches
+    if region is not None:
+        region_contig, start, end = region
+        keep = required['CHROM'].replace('chr', '') == region_contig
+        if start is not None:
+            keep = keep & (hl.int32(required['POS']) >= start) & (hl.int32(required['POS']) <= end)
+        ht = ht.filter(keep)
+    if fraction is not None:
+        ht = ht.filter(hl.rand_bool(fraction, seed=DRY_RUN_SEED))
+
+    ht = ht.key_by(
+        locus=hl.locus(contig, hl.int32(required['POS'])),
+        alleles=hl.array([required['REF']]).extend(required['ALT'].split(','))
+    ).select()
+
+    # drop duplicates
+    ht = ht.distinct()
+
+    # add the row fields (and placeholder sample) that hl.import_vcf would
+    # create; it reads a missing QUAL ('.') as -10.0
+    ht = ht.annotate(rsid=hl.missing(hl.tstr),
+                     qual=hl.float64(-10.0),
+                     filters=hl.missing(hl.tset(hl.tstr)),
+                     info=hl.struct())
+    if sites_only:
+        return ht
+
+    ht = ht.annotate(**{FAKE_SAMPLE: hl.struct(GT=hl.call(0, 1))})
+    return ht.to_matrix_table_row_major([FAKE_SAMPLE], col_field_name='s')
+
+
+def import_input(config, report=None, min_partitions=None, staging_dir='hdfs:///tmp/'):
+    """Import the config's input VCF as split, biallelic Hail variants using
+    the configured 'ingest-mode' ('pandas' by default, or 'native').
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :param report: Run report recording stage timings.
+    :type report: RunReport
+    :param min_partitions: Minimum number of partitions to import into, from `plan_resources`.
+    :type min_partitions: int
+    :param staging_dir: Directory the 'pandas' ingest mode stages the formatted VCF in.
+    :type staging_dir: str
+    :raises Exception: Unknown ingest mode.
+    :return: Input variants keyed by locus and alleles; a sites Table if 'sites-only' is set.
+    :rtype: hail.MatrixTable or hail.Table
+    """
+
+    report = report if report is not None else RunReport()
+    input_path = config['script-params']['input-vcf']['value']
+    ingest_mode = get_param(config, 'ingest-mode', 'pandas')
+
+    if ingest_mode not in INGEST_MODES:
+        raise Exception(f"Ingest mode {ingest_mode} is invalid! Expecting values in: {INGEST_MODES}.")
+
+    # skip parsing, staging and splitting if a previous attempt finished them
+    vcf = report.restore('input')
+    if vcf is not None:
+        return vcf
+
+    if ingest_mode == 'native':
+        print(f"Importing {input_path} directly into Hail.")
+        if get_param(config, 'presence-filter') is not None:
+            print("The presence filter is only applied with the 'pandas' ingest mode; joining every variant.")
+        with report.stage('import_vcf_native'):
+            region, fraction = dry_run_settings(config)
+            vcf = import_vcf_native(input_path, use_chr=False, min_partitions=min_partitions,
+                                    region=region, fraction=fraction,
+                                    sites_only=get_param(config, 'sites-only', True))
+            vcf = split_variants(vcf)
+            return report.checkpoint(vcf, 'input')
+
+    # stream VCF as pandas chunks
+    input_df = read_vcf(input_path, chunksize=get_param(config, 'read-chunk-size', READ_CHUNK_SIZE))
+    return vcf_to_mt(input_df, config, report, min_partitions, staging_dir)
+
+
+def align_partitions(vcf, path, n_partitions=None):
+    """Write the input and read it back with partitions chosen from its own
+    key distribution. Reading GnomAD with the same partitions (see
+    `read_reference_table`) lines both sides of the join up, so the join
+    needs no shuffle and GnomAD is only read over the input's key ranges.
+
+    :param vcf: Split input variants keyed by locus and alleles.
+    :type vcf: hail.MatrixTable or hail.Table
+    :param path: Path to write the input to, without extension; '.mt' or '.ht' is appended by type.
+    :type path: str
+    :param n_partitions: Number of partitions; by default one per ALIGN_ROWS_PER_PARTITION rows.
+    :type n_partitions: int
+    :return: tuple with the re-read input and its partition key intervals
+    :rtype: tuple
+    """
+
+    is_mt = isinstance(vcf, hl.MatrixTable)
+    path += '.mt' if is_mt else '.ht'
+    vcf = vcf.checkpoint(path, overwrite=True)
+
+    if n_partitions is None:
+        n_rows = vcf.count_rows() if is_mt else vcf.count()
+        n_partitions = max(1, -(-n_rows // ALIGN_ROWS_PER_PARTITION))
+
+    # _calculate_new_partitions and _intervals are private Hail APIs that may
+    # change between 0.2.x releases, hence the exact hail pin in pyproject.toml
+    partitions = vcf._calculate_new_partitions(n_partitions)
+    if is_mt:
+        return hl.read_matrix_table(path, _intervals=partitions), partitions
+    return hl.read_table(path, _intervals=partitions), partitions
+
+
+def variant_id(locus, alleles):
+    """Build the `variant` output string, e.g. '1:12345A>T'.
+
+    :param locus: Locus of a biallelic variant.
+    :type locus: hail.LocusExpression
+    :param alleles: Reference and alternate allele.
+    :type alleles: hail.ArrayExpression
+    :return: Variant identifier.
+    :rtype: hail.StringExpression
+    """
+
+    return locus.contig + ':' + hl.format('%s', locus.position) + alleles[0] + '>' + alleles[1]
+
+
+def variant_rows(vcf):
+    """Return the variant rows of an input, which may be a MatrixTable or a
+    sites-only Table.
+
+    :param vcf: Input variants.
+    :type vcf: hail.MatrixTable or hail.Table
+    :return: Table of variant rows.
+    :rtype: hail.Table
+    """
+
+    return vcf.rows() if isinstance(vcf, hl.MatrixTable) else vcf
+
+
+def export_rows(rows, annotations):
+    """Shape an annotated sites table like the output of `export_entries`,
+    with the placeholder sample as the `s` column.
+
+    :param rows: Table annotated with the `annotations` fields.
+    :type rows: hail.Table
+    :param annotations: Annotation columns, as returned by `annotation_fields`.
+    :type annotations: list
+    :return: Table ready for export.
+    :rtype: hail.Table
+    """
+
+    rows = rows.annotate(s=FAKE_SAMPLE)
+    fields = [i for i in rows.row_value if i not in annotations + ['s']] + ['s'] + annotations
+    return rows.select(*fields)
+
+
+def export_entries(vcf, annotations):
+    """Flatten an annotated MatrixTable to one row per entry, keeping the
+    annotation fields as the trailing columns of the output.
+
+    :param vcf: MatrixTable annotated with the `annotations` row fields.
+    :type vcf: hail.MatrixTable
+    :param annotations: Annotation columns, as returned by `annotation_fields`.
+    :type annotations: list
+    :return: Entries table ready for export.
+    :rtype: hail.Table
+    """
+
+    export = vcf.select_entries().entries()
+    fields = [i for i in export.row_value if i not in annotations] + annotations
+    return export.select(*fields)
+
+
+def write_manifest(output_path, output_format, columns):
+    """Write a manifest.json listing the shards of a directory output.
+
+    :param output_path: Directory written by `export_annotations`.
+    :type output_path: str
+    :param output_format: Format the directory was written in.
+    :type output_format: str
+    :param columns: Column names of the output.
+    :type columns: list
+    """
+
+    fs = get_filesystem(output_path)
+    shards = [{'path': os.path.basename(i['path']), 'size_bytes': i['size_bytes']}
+              for i in fs.ls(output_path)
+              if not i['is_dir'] and os.path.basename(i['path']).startswith('part-')]
+    manifest = {'format': output_format,
+                'columns': columns,
+                'shards': sorted(shards, key=lambda x: x['path'])}
+
+    with fs.open(os.path.join(output_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+
+def export_annotations(export, output_path, output_format='tsv'):
+    """Write the annotated table in the requested format. Apart from 'tsv',
+    every format is written in parallel by the executors.
+
+    - tsv: a single tab-delimited text file.
+    - tsv-sharded: a directory of block-gzipped TSV shards, each with a header, plus a manifest.json.
+    - parquet: a Parquet dataset written through Spark, with nested fields flattened.
+    - hail-table: a native Hail table.
+
+    :param export: Annotated table, as returned by `export_entries`.
+    :type export: hail.Table
+    :param output_path: Path to write to.
+    :type output_path: str
+    :param output_format: One of OUTPUT_FORMATS.
+    :type output_format: str
+    :raises Exception: Unknown output format.
+    :raises Exception: A 'tsv-sharded' output path does not end in '.bgz' (see `normalize_output_name`).
+    :raises Exception: A 'parquet' output column name still contains '.'.
+    """
+
+    if output_format not in OUTPUT_FORMATS:
+        raise Exception(f"Output format {output_format} is invalid! Expecting values in: {OUTPUT_FORMATS}.")
+    if output_format == 'tsv-sharded' and not output_path.rstrip('/').endswith('.bgz'):
+        raise Exception(f"Output path {output_path} of a 'tsv-sharded' output must end in '.bgz'!")
+
+    if output_format == 'tsv':
+        export.export(output_path)
+
+    if output_format == 'tsv-sharded':
+        export.export(output_path, parallel='header_per_shard')
+        write_manifest(output_path, output_format, list(export.row))
+
+    if output_format == 'parquet':
+        # loci are written as in the TSV outputs; to_spark would otherwise
+        # expand and flatten them (and sets) itself, into dotted column names
+        # that Parquet cannot store, so flatten and rename first
+        df = export.key_by()
+        df = df.annotate(**{i: hl.str(df[i]) for i in ['locus', 'old_locus'] if i in df.row})
+        df = df.expand_types().flatten()
+        df = df.rename({i: i.replace('.', '_') for i in df.row if '.' in i})
+        df = df.to_spark(flatten=False)
+        dotted = [i for i in df.columns if '.' in i]
+        if dotted:
+            raise Exception(f"Parquet output columns {dotted} contain '.'!")
+        df.write.mode('overwrite').parquet(output_path)
+
+    if output_format == 'hail-table':
+        export.write(output_path, overwrite=True)
+
+
+def count_filtered_rows(vcf, config):
+    """Count variants before and after each allele frequency filter in one
+    aggregation.
+
+    :param vcf: Input annotated with `annotation_fields`, before filtering.
+    :type vcf: hail.MatrixTable or hail.Table
+    :param config: Loaded config.json file.
+    :type config: dict
+    :return: Row counts keyed by filter stage.
+    :rtype: dict
+    """
+
+    af_cutoff = config['script-params']['allele-frequency-cutoff']['value']
+    counts = {'input': hl.agg.count()}
+    if 'novel' in vcf.row:
+        counts['novel'] = hl.agg.count_where(vcf.novel)
+    passed = hl.bool(True)
+    for db, source in annotation_sources(config).items():
+        filtered = [column for column, field in source['fields'].items() if field['af-filter']]
+        if not filtered:
+            continue
+        for column in filtered:
+            passed = passed & (vcf[column] < af_cutoff)
+        counts[f'after_{db}_filter'] = hl.agg.count_where(passed)
+
+    if isinstance(vcf, hl.MatrixTable):
+        return dict(vcf.aggregate_rows(hl.struct(**counts)))
+    return dict(vcf.aggregate(hl.struct(**counts)))
+
+
+def hail_annotate(vcf, config, report=None, join_partitions=None):
+    """Runs Hail annotation scripts for all input GnomAD databases.
+
+    :param vcf: Split input variants, as returned by `import_input`.
+    :type vcf: hail.MatrixTable
+
+    :param output_path: Output path on DataProc instance to use for writing annotated data. 
+    Output data contains epopmax, gpopmax, and proportion_expressed,
+    keyed by variant. Allele frequency > 0.01 is returned as NA.
+    :type output_path: str
+
+    :param config: Path to config JSON file containing workflow parameters.
+    :type config: str
+
+    :param report: Run report recording stage timings and row counts.
+    :type report: RunReport
+
+    :param join_partitions: Partition count to coalesce the input to before joins, from `plan_resources`.
+    :type join_partitions: int
+
+    :return: Path of the exported output.
+    :rtype: str
+    """    
+            
+    report = report if report is not None else RunReport()
+
+    # avoid joining through many near-empty partitions
+    if join_partitions is not None and vcf.n_partitions() > join_partitions:
+        vcf = vcf.naive_coalesce(join_partitions)
+
+    cache_dir = get_param(config, 'annotation-cache')
+    if cache_dir is not None:
+
+        # only join variants missing from the cache against GnomAD
+        print(f"Adding annotations through cache: {cache_dir}")
+        restored = report.restore('annotated')
+        if restored is not None:
+            vcf = restored
+        else:
+            with report.stage('add_db_annotations_cached'):
+                vcf = report.checkpoint(annotate_from_cache(vcf, config, cache_dir), 'annotated')
+
+    else:
+
+        # continue after the last source annotated by a previous attempt
+        remaining = list(annotation_sources(config))
+        while remaining and report.is_complete(f'annotated_{remaining[0]}'):
+            vcf = report.restore(f'annotated_{remaining.pop(0)}')
+
+        intervals, partitions = None, None
+        if remaining and get_param(config, 'align-partitions', False):
+
+            # read input and GnomAD over the same key ranges
+            with report.stage('align_partitions'):
+                scratch_dir = report.checkpoint_dir or report.scratch_dir or CHECKPOINT_DIR
+                vcf, partitions = align_partitions(vcf, os.path.join(scratch_dir, 'aligned_input'),
+                                                   get_param(config, 'align-n-partitions'))
+            print(f"Aligned input and GnomAD to {len(partitions)} partitions.")
+
+        elif remaining:
+
+            # restrict GnomAD reads to the regions covered by the input
+            with report.stage('locus_intervals'):
+                intervals = locus_intervals(vcf)
+            print(f"Input covers {len(intervals)} locus intervals.")
+
+        for db in remaining:
+            
+            print(f"Adding annotations for: {db}")
+            with report.stage(f'add_db_annotations_{db}'):
+                vcf = add_db_annotations(vcf, db, config, intervals, apply_filter=False, partitions=partitions)
+                vcf = report.checkpoint(vcf, f'annotated_{db}')
+            print(f"Done with annotations for: {db}")
+
+    # count rows around each filter once the annotations are materialised
+    if report.checkpoint_dir is not None:
+        report.row_counts = count_filtered_rows(vcf, config)
+        print(f"Row counts: {report.row_counts}")
+
+    for source in annotation_sources(config).values():
+        vcf = filter_frequency(vcf, source, config)
+
+    # presence filter flags are not an output column
+    if 'novel' in vcf.row:
+        vcf = vcf.drop('novel')
+
+    # construct a variant expression
+    if isinstance(vcf, hl.MatrixTable):
+        vcf = vcf.annotate_rows(variant=variant_id(vcf.locus, vcf.alleles))
+        export = export_entries(vcf, annotation_fields(config))
+    else:
+        # sites-only input is exported row by row, with the same columns
+        vcf = vcf.annotate(variant=variant_id(vcf.locus, vcf.alleles))
+        export = export_rows(vcf, annotation_fields(config))
+    
+    # export table straight to its destination
+    output_format = get_param(config, 'output-format', 'tsv')
+    output_path = config['script-params']['output-name']['value']
+    with report.stage('export'):
+        export_annotations(export, output_path, output_format)
+    print(f"Wrote annotated VCF to {output_path}.")
+
+    return output_path
+
+
+@functools.lru_cache(maxsize=None)
+def reference_partitions(path):
+    """Read the number of partitions of a Hail table from its metadata,
+    once per path and process.
+
+    :param path: GCS path to a Hail table directory.
+    :type path: str
+    :return: Number of partitions, or None if it cannot be read.
+    :rtype: int
+    """
+
+    if not is_valid_gcs_path(path):
+        return None
+    try:
+        metadata = get_storage_backend().read_bytes(path.rstrip('/') + '/rows/metadata.json.gz')
+        return len(json.loads(gzip.decompress(metadata))['_partFiles'])
+    except Exception as e:
+        print(f"Could not read partition count of {path} ({type(e).__name__}).")
+        return None
+
+
+def estimate_variants(configs):
+    """Estimate the number of input variant rows from the size of each input file.
+
+    :param configs: Loaded configs (one per batch source).
+    :type configs: list
+    :return: Estimated rows, or None if an input size is unknown.
+    :rtype: int
+    """
+
+    n_variants = 0
+    for config in configs:
+        path = config['script-params']['input-vcf']['value']
+        size = get_storage_backend().blob_size(path) if is_valid_gcs_path(path) else None
+        if size is None:
+            return None
+        if path.endswith('.gz'):
+            size *= PLAN_GZIP_RATIO
+        n_variants += size // PLAN_BYTES_PER_VARIANT
+    return n_variants
+
+
+def plan_resources(configs):
+    """Choose partition counts and Spark conf for a run from the size of its
+    inputs and the partitioning of its reference tables. Hail sizes its
+    own shuffles from the partition counts; the Spark shuffle and
+    parallelism settings only apply to plain Spark operations. Entries of
+    the optional 'spark' config section override the plan.
+
+    :param configs: Loaded configs (one per batch source); the first one holds the 'spark' section.
+    :type configs: list
+    :raises Exception: A 'spark' entry is neither a plan override nor a 'spark.' conf key.
+    :return: Plan with 'estimated_variants', 'reference_partitions', 'min-partitions',
+    'join-partitions' and 'spark_conf'.
+    :rtype: dict
+    """
+
+    n_variants = estimate_variants(configs)
+    sources = annotation_sources(configs[0]).values()
+    counts = [reference_partitions(i['path']) for i in sources if i['key'] != 'interval']
+    n_reference = max([i for i in counts if i is not None], default=None)
+
+    # one partition per PLAN_VARIANTS_PER_PARTITION, never more than the references
+    if n_variants is None:
+        n_partitions = None
+    else:
+        n_partitions = max(1, -(-n_variants // PLAN_VARIANTS_PER_PARTITION))
+        if n_reference is not None:
+            n_partitions = min(n_partitions, n_reference)
+
+    plan = {'estimated_variants': n_variants,
+            'reference_partitions': n_reference,
+            'min-partitions': n_partitions,
+            'join-partitions': n_partitions,
+            'spark_conf': {}}
+    if n_partitions is not None:
+        plan['spark_conf'] = {'spark.sql.shuffle.partitions': str(n_partitions),
+                              'spark.default.parallelism': str(n_partitions)}
+
+    for key, entry in configs[0].get('spark', {}).items():
+        if key in PLAN_OVERRIDES:
+            plan[key] = entry['value']
+        elif key.startswith('spark.'):
+            plan['spark_conf'][key] = str(entry['value'])
+        else:
+            raise Exception(f"Spark config entry {key} is invalid! Expecting one of {PLAN_OVERRIDES} or a 'spark.' conf key.")
+
+    return plan
+
+
+def init_hail(plan):
+    """Start Hail with the Spark conf of a resource plan. Does nothing if
+    Hail was already started with the same settings.
+
+    :param plan: Plan from `plan_resources`.
+    :type plan: dict
+    """
+
+    hl.init(spark_conf=plan['spark_conf'] or None, idempotent=True)
+
+
+def run_signature(configs):
+    """Fingerprint the settings that determine a run's checkpoints, so a
+    rerun only resumes from checkpoints made with the same inputs.
+
+    :param configs: Loaded configs of the run (one per batch source).
+    :type configs: list
+    :return: Hex digest.
+    :rtype: str
+    """
+
+    settings = [{'input-vcf': config['script-params']['input-vcf']['value'],
+                 'dry-run': dry_run_settings(config),
+                 'ingest-mode': get_param(config, 'ingest-mode', 'pandas'),
+                 'sites-only': get_param(config, 'sites-only', True),
+                 'annotation-cache': get_param(config, 'annotation-cache'),
+                 'presence-filter': get_param(config, 'presence-filter'),
+                 'sources': annotation_sources(config)}
+                for config in configs]
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def execute_annotation(config_path):
+    """Wrapper which opens config path, reads input VCF, 
+    and launches annotation script.
+
+    :param input_path: Path (on DataProc instance) to input, tab-delimited file with CHROM, POS, REF, ALT columns.
+    :type input_path: str
+
+    :param output_path: Output path (on DataProc instance) to use for writing output, annotated data.
+    :type output_path: str
+
+    :param config_path: Path (on DataProc instance) to config JSON file containing workflow parameters.
+    :type config_path: str
+    """
+
+    report = RunReport()
+
+    # import config
+    with report.stage('import_config'):
+        config = import_config(config_path)
+    print("Imported config.")
+
+    run_annotation(config, report)
+
+
+def run_annotation(config, report, start_hail=True, staging_dir='hdfs:///tmp/'):
+    """Annotate the input of a loaded config and write its output and run
+    report.
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :param report: Run report recording stage timings and row counts.
+    :type report: RunReport
+    :param start_hail: If False, Hail is already running (see `AnnotationServer`) and its Spark conf is kept.
+    :type start_hail: bool
+    :param staging_dir: Directory to stage the formatted input VCF in.
+    :type staging_dir: str
+    :return: Path of the annotated output.
+    :rtype: str
+    """
+
+    # small inputs can be annotated in-process, without starting Spark; the
+    # engine checks its index against the sources instead of running preflight
+    engine = get_param(config, 'engine', 'hail')
+    if engine not in ENGINES:
+        raise Exception(f"Engine {engine} is invalid! Expecting values in: {ENGINES}.")
+    if engine == 'local':
+        destination_path = annotate_local(config, report)
+        if get_param(config, 'run-report', True):
+            report.write(destination_path.rstrip('/') + '.run-report.json', jvm=False)
+        print(f"Run completed. Annotated file written to {destination_path}")
+        return destination_path
+
+    # fail fast on missing inputs, unwritable outputs or bad references
+    if get_param(config, 'preflight', True):
+        with report.stage('preflight'):
+            preflight(config)
+
+    # size partitions and Spark to the input before Hail starts
+    with report.stage('plan_resources'):
+        report.plan = plan_resources([config])
+        if start_hail:
+            init_hail(report.plan)
+    print(f"Resource plan: {report.plan}")
+
+    # checkpoint stages so timings and row counts are cheap to collect, in a
+    # directory of this run so concurrent runs on a cluster stay apart
+    write_report = get_param(config, 'run-report', True)
+    report.scratch_dir = os.path.join(CHECKPOINT_DIR, uuid.uuid4().hex)
+    if write_report:
+        report.checkpoint_dir = report.scratch_dir
+
+    # keep checkpoints of a named run so a rerun skips completed stages
+    run_id = get_param(config, 'run-id')
+    if run_id is not None:
+        run_dir = os.path.join(get_param(config, 'work-dir', CHECKPOINT_DIR), run_id)
+        report.resume_run(run_dir, run_signature([config]))
+
+    completed = False
+    try:
+        # import input variants
+        vcf = import_input(config, report, report.plan['min-partitions'], staging_dir)
+
+        # run annotation script
+        output_path = hail_annotate(vcf, config, report, report.plan['join-partitions'])
+
+        # output is exported directly, so this only copies if it was written elsewhere
+        destination_path = config['script-params']['output-name']['value']
+        with report.stage('upload_to_cloud'):
+            upload_to_cloud(output_path, destination_path)
+
+        if write_report:
+            report.write(destination_path.rstrip('/') + '.run-report.json')
+        completed = True
+    finally:
+        # a failed named run keeps its checkpoints so a rerun can resume
+        report.cleanup(keep_checkpoints=not completed and run_id is not None)
+
+    print(f"Run completed. Annotated file written to {destination_path}")
+    return destination_path
+
+
+def batch_configs(config_paths, input_paths):
+    """Load the configs of a batch run. Every extra input VCF gets a copy of
+    the first config, with its output written next to the first config's
+    output as <input name>.annotated<extension>.
+
+    :param config_paths: GCS paths to one or more configs.
+    :type config_paths: list
+    :param input_paths: Additional input VCFs annotated with the first config.
+    :type input_paths: list
+    :raises Exception: Configs declare different annotation sources.
+    :return: One loaded config per batch source.
+    :rtype: list
+    """
+
+    configs = [import_config(i) for i in config_paths]
+    base = configs[0]
+
+    for path in input_paths:
+        config = copy.deepcopy(base)
+        extension = OUTPUT_EXTENSIONS[get_param(base, 'output-format', 'tsv')]
+        output_dir = os.path.dirname(base['script-params']['output-name']['value'].rstrip('/'))
+        config['script-params']['input-vcf']['value'] = path
+        config['script-params']['output-name']['value'] = os.path.join(
+            output_dir, os.path.basename(path) + '.annotated' + extension)
+        configs.append(config)
+
+    # all sources share one annotation pass
+    for config in configs[1:]:
+        if annotation_sources(config) != annotation_sources(base):
+            raise Exception("All configs in a batch must use the same annotation sources!")
+
+    return configs
+
+
+def execute_batch(config_paths, input_paths):
+    """Annotate many inputs in one Hail session. Variants from every input
+    are unioned into one table tagged by source, annotated once against
+    GnomAD, and written to a separate output per source. Each source keeps
+    its own allele frequency cutoff, testing flag and output settings.
+
+    :param config_paths: GCS paths to one or more configs.
+    :type config_paths: list
+    :param input_paths: Additional input VCFs annotated with the first config.
+    :type input_paths: list
+    """
+
+    report = RunReport()
+    with report.stage('import_config'):
+        configs = batch_configs(config_paths, input_paths)
+    base = configs[0]
+    print(f"Imported {len(configs)} batch configs.")
+
+    # fail fast on missing inputs, unwritable outputs or bad references
+    if get_param(base, 'preflight', True):
+        with report.stage('preflight'):
+            for config in configs:
+                preflight(config)
+
+    with report.stage('plan_resources'):
+        report.plan = plan_resources(configs)
+        init_hail(report.plan)
+    print(f"Resource plan: {report.plan}")
+
+    # inputs are read lazily from their staged files, and the annotated
+    # variants feed one export per source, so both are always checkpointed
+    write_report = get_param(base, 'run-report', True)
+    report.scratch_dir = os.path.join(CHECKPOINT_DIR, uuid.uuid4().hex)
+    report.checkpoint_dir = report.scratch_dir
+
+    run_id = get_param(base, 'run-id')
+    if run_id is not None:
+        run_dir = os.path.join(get_param(base, 'work-dir', CHECKPOINT_DIR), run_id)
+        report.resume_run(run_dir, run_signature(configs))
+
+    completed = False
+    try:
+        # union input variants, tagged by source
+        tables = []
+        for source, config in enumerate(configs):
+            print(f"Importing batch source {source}: {config['script-params']['input-vcf']['value']}")
+            vcf = import_input(config, report, report.plan['min-partitions'],
+                               staging_dir=os.path.join(report.scratch_dir, 'staging', str(source)))
+            rows = variant_rows(vcf)
+            if 'novel' in rows.row:
+                rows = rows.drop('novel')
+            tables.append(rows.annotate(source=source))
+        variants = tables[0].union(*tables[1:])
+
+        # annotate each distinct variant once
+        unique = report.restore('batch_annotated')
+        if unique is None:
+            with report.stage('add_db_annotations_batch'):
+                unique = variants.select().distinct()
+                cache_dir = get_param(base, 'annotation-cache')
+                if cache_dir is not None:
+                    unique = annotate_from_cache(unique, base, cache_dir)
+                else:
+                    unique = annotate_variant_table(unique, base)
+                unique = report.checkpoint(unique, 'batch_annotated')
+        variants = variants.annotate(**unique[variants.key])
+        variants = variants.annotate(variant=variant_id(variants.locus, variants.alleles))
+
+        # write one output per source
+        for source, config in enumerate(configs):
+            rows = variants.filter(variants.source == source).drop('source')
+            for annotations in annotation_sources(config).values():
+                rows = filter_frequency(rows, annotations, config)
+
+            output_path = config['script-params']['output-name']['value']
+            with report.stage(f'export_{source}'):
+                export_annotations(export_rows(rows, annotation_fields(config)), output_path,
+                                   get_param(config, 'output-format', 'tsv'))
+            print(f"Wrote annotated batch source {source} to {output_path}.")
+
+        if write_report:
+            output_dir = os.path.dirname(base['script-params']['output-name']['value'].rstrip('/'))
+            report.write(os.path.join(output_dir, 'batch.run-report.json'))
+        completed = True
+    finally:
+        # a failed named run keeps its checkpoints so a rerun can resume
+        report.cleanup(keep_checkpoints=not completed and run_id is not None)
+
+    print(f"Batch completed. Annotated {len(configs)} inputs.")
+
+
+def variant_keys(pos, ref, alt):
+    """Pack variants into sortable uint64 keys of a local frequency index:
+    the position in the high 32 bits and a 32-bit hash of 'REF>ALT' in the
+    low 32 bits.
+
+    :param pos: Positions.
+    :type pos: np.ndarray
+    :param ref: Reference alleles.
+    :type ref: np.ndarray
+    :param alt: Alternate alleles.
+    :type alt: np.ndarray
+    :return: Variant keys.
+    :rtype: np.ndarray
+    """
+
+    alleles = (pd.Series(ref, dtype=object) + '>' + pd.Series(alt, dtype=object)).to_numpy(dtype=object)
+    hashes = pd.util.hash_array(alleles) & np.uint64(0xFFFFFFFF)
+    return (np.asarray(pos).astype(np.uint64) << np.uint64(32)) | hashes
+
+
+def build_local_index(config, output_dir):
+    """Write a compact per-contig frequency index for the local engine. For
+    each contig, `<contig>.keys.npy` holds the sorted `variant_keys` of every
+    biallelic variant and `<contig>.values.npy` a float32 row of annotation
+    columns per key (NaN where missing). `index.json` lists the columns,
+    contigs and the annotation sources the index was built from.
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :param output_dir: Local or gs:// directory to write the index to.
+    :type output_dir: str
+    :raises Exception: An annotation source is not keyed by locus and alleles.
+    """
+
+    sources = annotation_sources(config)
+    unsupported = [name for name, source in sources.items() if source['key'] != 'locus-alleles']
+    if unsupported:
+        raise Exception(f"The local index only supports locus-alleles sources, not: {', '.join(unsupported)}.")
+
+    ht = read_source(list(sources.values())[0])
+    for source in list(sources.values())[1:]:
+        ht = ht.join(read_source(source), how='outer')
+    ht = ht.filter(hl.len(ht.alleles) == 2)
+
+    columns = annotation_fields(config)
+    rg = ht.locus.dtype.reference_genome
+    index = {'sources': cache_sources(sources), 'columns': columns, 'contigs': {}}
+    for contig in rg.contigs:
+        part = hl.filter_intervals(ht, [hl.parse_locus_interval(contig, reference_genome=rg)])
+        part = part.key_by().select(pos=part.locus.position, ref=part.alleles[0], alt=part.alleles[1],
+                                    **{column: hl.float64(part[column]) for column in columns})
+        df = part.to_pandas()
+        if df.empty:
+            continue
+
+        # contigs are stored without 'chr', matching normalized inputs
+        name = contig.replace('chr', '')
+        keys = variant_keys(df.pos.to_numpy(), df.ref.to_numpy(), df.alt.to_numpy())
+        order = np.argsort(keys, kind='stable')
+        for suffix, array in [('keys', keys[order]),
+                              ('values', df[columns].to_numpy(dtype=np.float32)[order])]:
+            with fsspec.open(os.path.join(output_dir, f'{name}.{suffix}.npy'), 'wb') as f:
+                np.save(f, array)
+        index['contigs'][name] = len(df)
+        print(f"Indexed {len(df)} variants on contig {contig}.")
+
+    with fsspec.open(os.path.join(output_dir, LOCAL_INDEX_META), 'w') as f:
+        json.dump(index, f, indent=4)
+    print(f"Wrote local frequency index to {output_dir}.")
+
+
+@functools.lru_cache(maxsize=None)
+def open_local_index(path):
+    """Open a local frequency index. A gs:// index is downloaded once to
+    LOCAL_INDEX_CACHE, and again only when its index.json changes.
+
+    :param path: Local or gs:// directory written by `build_local_index`.
+    :type path: str
+    :return: tuple with the local directory and the index metadata
+    :rtype: tuple
+    """
+
+    with fsspec.open(os.path.join(path, LOCAL_INDEX_META), 'r') as f:
+        meta_text = f.read()
+
+    local_dir = path.replace('file://', '', 1)
+    if '://' in local_dir:
+        local_dir = os.path.join(LOCAL_INDEX_CACHE, hashlib.sha256(path.encode()).hexdigest()[:16])
+        cached_meta = os.path.join(local_dir, LOCAL_INDEX_META)
+        if not os.path.exists(cached_meta) or open(cached_meta).read() != meta_text:
+            print(f"Downloading local frequency index {path} to {local_dir}.")
+            fs, root = fsspec.core.url_to_fs(path)
+            fs.get(root.rstrip('/') + '/', local_dir + '/', recursive=True)
+
+    return local_dir, json.loads(meta_text)
+
+
+def min_rep(pos, ref, alt):
+    """Trim bases shared by the reference and alternate allele, first from
+    the end and then from the start (shifting the position), as Hail does
+    when splitting multiallelic variants.
+
+    :param pos: Positions.
+    :type pos: pd.Series
+    :param ref: Reference alleles.
+    :type ref: pd.Series
+    :param alt: Alternate alleles.
+    :type alt: pd.Series
+    :return: tuple with the trimmed positions, reference and alternate alleles
+    :rtype: tuple
+    """
+
+    pos, ref, alt = pos.copy(), ref.copy(), alt.copy()
+    for end in [-1, 0]:
+        while True:
+            trim = (ref.str.len() > 1) & (alt.str.len() > 1) & (ref.str[end] == alt.str[end])
+            if not trim.any():
+                break
+            if end == -1:
+                ref[trim], alt[trim] = ref[trim].str[:-1], alt[trim].str[:-1]
+            else:
+                ref[trim], alt[trim] = ref[trim].str[1:], alt[trim].str[1:]
+                pos[trim] += 1
+    return pos, ref, alt
+
+
+def split_variant_rows(input_df):
+    """Split normalized VCF rows into biallelic variants with the row fields
+    Hail's split_multi adds, in pandas.
+
+    :param input_df: Rows from `normalize_vcf_rows`.
+    :type input_df: pd.DataFrame
+    :return: One row per alternate allele, with CHROM, POS, REF, ALT, a_index,
+    was_split, old_locus and old_alleles columns.
+    :rtype: pd.DataFrame
+    """
+
+    alts = input_df.ALT.str.split(',')
+    df = input_df[['CHROM', 'POS', 'REF']].assign(
+        was_split=alts.str.len() > 1,
+        old_locus=input_df.CHROM + ':' + input_df.POS.astype(str),
+        old_alleles='["' + input_df.REF + '","' + input_df.ALT.str.replace(',', '","') + '"]',
+        ALT=alts).reset_index(drop=True)
+    df = df.explode('ALT')
+    df['a_index'] = df.groupby(level=0).cumcount() + 1
+    df = df[df.ALT != '*'].reset_index(drop=True)
+
+    df['POS'], df['REF'], df['ALT'] = min_rep(df.POS, df.REF, df.ALT.astype(str))
+    return df.drop_duplicates(['CHROM', 'POS', 'REF', 'ALT'])
+
+
+def lookup_local_index(variants, index_dir, meta):
+    """Look variants up in a local frequency index with vectorized
+    searchsorted calls over memory-mapped per-contig arrays.
+
+    :param variants: Variants from `split_variant_rows`.
+    :type variants: pd.DataFrame
+    :param index_dir: Local directory of the index.
+    :type index_dir: str
+    :param meta: Index metadata.
+    :type meta: dict
+    :return: float32 array with one row per variant and one column per index column (NaN if absent).
+    :rtype: np.ndarray
+    """
+
+    values = np.full((len(variants), len(meta['columns'])), np.nan, dtype=np.float32)
+    keys = variant_keys(variants.POS.to_numpy(), variants.REF.to_numpy(), variants.ALT.to_numpy())
+
+    for contig, rows in variants.groupby('CHROM').indices.items():
+        if contig not in meta['contigs']:
+            continue
+        index_keys = np.load(os.path.join(index_dir, f'{contig}.keys.npy'), mmap_mode='r')
+        index_values = np.load(os.path.join(index_dir, f'{contig}.values.npy'), mmap_mode='r')
+
+        found = np.minimum(np.searchsorted(index_keys, keys[rows]), len(index_keys) - 1)
+        hit = index_keys[found] == keys[rows]
+        values[rows[hit]] = index_values[found[hit]]
+
+    return values
+
+
+def annotate_local(config, report=None):
+    """Annotate the config's input in-process from a local frequency index,
+    without Spark. Produces the same TSV columns as the Hail path, after the
+    same allele frequency filters.
+
+    :param config: Loaded config.json file.
+    :type config: dict
+    :param report: Run report recording stage timings and row counts.
+    :type report: RunReport
+    :raises Exception: Output format is not 'tsv'.
+    :raises Exception: Index was built from different annotation sources.
+    :return: Path of the exported output.
+    :rtype: str
+    """
+
+    report = report if report is not None else RunReport()
+    output_path = config['script-params']['output-name']['value']
+    if get_param(config, 'output-format', 'tsv') != 'tsv':
+        raise Exception("The local engine only writes the 'tsv' output format!")
+
+    sources = annotation_sources(config)
+    index_dir, meta = open_local_index(get_param(config, 'local-index'))
+    if meta['sources'] != cache_sources(sources):
+        raise Exception("Local index was built from different annotation sources; rebuild it with --build-local-index.")
+
+    # read, restrict, normalize and split the input on the driver
+    with report.stage('read_local'):
+        region, fraction = dry_run_settings(config)
+        rng = np.random.default_rng(DRY_RUN_SEED)
+        chunks = [normalize_vcf_rows(restrict_rows(chunk, region, fraction, rng)[['CHROM', 'POS', 'REF', 'ALT']],
+                                     use_chr=False, sites_only=True)
+                  for chunk in read_vcf(config['script-params']['input-vcf']['value'])]
+        variants = split_variant_rows(pd.concat(chunks, ignore_index=True))
+
+    with report.stage('lookup_local'):
+        values = lookup_local_index(variants, index_dir, meta)
+
+    # fill defaults and apply the allele frequency filters of each source
+    af_cutoff = config['script-params']['allele-frequency-cutoff']['value']
+    annotations = pd.DataFrame(values, columns=meta['columns'])
+    passed = np.ones(len(variants), dtype=bool)
+    report.row_counts = {'input': len(variants)}
+    for db, source in sources.items():
+        filtered = False
+        for column, field in source['fields'].items():
+            if field['default'] is not None:
+                annotations[column] = annotations[column].fillna(field['default'])
+            if field['af-filter']:
+                passed &= (annotations[column] < af_cutoff).to_numpy()
+                filtered = True
+        if filtered:
+            report.row_counts[f'after_{db}_filter'] = int(passed.sum())
+    variants, annotations = variants[passed], annotations[passed]
+
+    # order rows by locus and alleles, as the Hail path exports them
+    order = np.lexsort((variants.ALT.to_numpy(dtype=str), variants.REF.to_numpy(dtype=str),
+                        variants.POS.to_numpy(), contig_rank(variants.CHROM.to_numpy(dtype=str))))
+    variants, annotations = variants.iloc[order], annotations.iloc[order]
+
+    # shape rows like a sites export from the Hail path
+    locus = variants.CHROM + ':' + variants.POS.astype(str)
+    export = pd.DataFrame({'locus': locus,
+                           'alleles': '["' + variants.REF + '","' + variants.ALT + '"]',
+                           'rsid': None,
+                           'qual': -10.0,
+                           'filters': None,
+                           'info': '{}',
+                           'a_index': variants.a_index,
+                           'was_split': np.where(variants.was_split, 'true', 'false'),
+                           'old_locus': variants.old_locus,
+                           'old_alleles': variants.old_alleles,
+                           'variant': locus + variants.REF + '>' + variants.ALT,
+                           's': FAKE_SAMPLE}, columns=LOCAL_ROW_FIELDS)
+    export = export.astype(object).where(export.notna(), 'NA').astype(str)
+
+    # format float32 values at their own precision, missing values as NA
+    annotations = annotations.astype(str).replace('nan', 'NA')
+    export = pd.concat([export.reset_index(drop=True), annotations.reset_index(drop=True)], axis=1)
+
+    # write fields unquoted, as Hail's export does
+    with report.stage('export'):
+        with get_filesystem(output_path, jvm=False).open(output_path, 'w') as f:
+            f.write('\t'.join(export.columns) + '\n')
+            f.writelines('\t'.join(row) + '\n' for row in export.itertuples(index=False))
+    print(f"Wrote {len(export)} annotated variants to {output_path}.")
+
+    return output_path
+
+
+def upload_to_cloud(output_path, destination_path):
+    """Copy annotated file (or output directory) to its destination. Requires "Storage Folder Admin" permission.
+    Nothing is copied when the output was already written to the destination.
+
+    :param output_path: Path written by `hail_annotate`
+    :type output_path: str
+    :param destination_path: GCP Destination path parsed from Config
+    :type destination_path: str
+    """
+
+    if output_path == destination_path:
+        return
+
+    # Hail's filesystem copies between any schemes; purely local copies skip it
+    if all([isinstance(get_filesystem(i), LocalFileSystem) for i in [output_path, destination_path]]):
+        fs = LocalFileSystem()
+    else:
+        fs = HailFileSystem()
+    fs.copy(output_path, destination_path)
+
+    print(f"Annotated output loaded to {destination_path}.")
+
+
+class AnnotationServer:
+    """Run annotation jobs in one long-running Hail session. Hail is started
+    once, and opened reference tables, their metadata and presence filters
+    stay cached between jobs. At most `workers` jobs run at a time and at
+    most SERVER_MAX_PENDING are queued or running; jobs that update an
+    annotation cache run one at a time. A job is either a config path, or an
+    inline list of variants annotated with the server's base config."""
+
+    def __init__(self, base_config, workers=SERVER_WORKERS):
+        self.base_config = base_config
+        self.plan = plan_resources([base_config])
+        init_hail(self.plan)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+
+    def submit(self, request):
+        # validate the request shape now, so a bad request fails without a job
+        if 'config' in request:
+            if not isinstance(request['config'], str):
+                raise ValueError("'config' must be a config path.")
+        elif 'variants' in request:
+            if not request['variants'] or not isinstance(request['variants'], list):
+                raise ValueError("'variants' must be a non-empty list of [CHROM, POS, REF, ALT] entries.")
+            if not is_valid_gcs_path(str(request.get('output-name'))):
+                raise ValueError("Inline variant jobs need a gs:// 'output-name'.")
+        else:
+            raise ValueError("Expecting a 'config' path or a 'variants' list.")
+
+        job_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            pending = sum(job['status'] in ('queued', 'running') for job in self.jobs.values())
+            if pending >= SERVER_MAX_PENDING:
+                raise RuntimeError(f"{pending} jobs are already queued or running, try again later.")
+            # forget the oldest finished jobs
+            finished = [i for i, job in self.jobs.items() if job['status'] in ('succeeded', 'failed')]
+            for i in finished[:max(0, len(self.jobs) - SERVER_MAX_JOBS + 1)]:
+                del self.jobs[i]
+            self.jobs[job_id] = {'id': job_id,
+                                 'status': 'queued',
+                                 'submitted': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                 'output': request.get('output-name'),
+                                 'run_report': None,
+                                 'error': None}
+        self.executor.submit(self._run, job_id, request)
+        return self.status(job_id)
+
+    def status(self, job_id=None):
+        with self._lock:
+            if job_id is None:
+                return [dict(job) for job in self.jobs.values()]
+            return dict(self.jobs[job_id]) if job_id in self.jobs else None
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self.jobs[job_id].update(fields)
+
+    def job_config(self, job_id, request):
+        # inline variants are written next to their output and annotated with the base config
+        if 'config' in request:
+            fetch_config_text.cache_clear()
+            config = import_config(request['config'])
+        else:
+            config = copy.deepcopy(self.base_config)
+            output_path = request['output-name']
+            input_path = output_path.rstrip('/') + '.input.tsv'
+            variants = pd.DataFrame(request['variants'], columns=['CHROM', 'POS', 'REF', 'ALT'])
+            with get_filesystem(input_path).open(input_path, 'w') as f:
+                variants.to_csv(f, sep='\t', index=False)
+            config['script-params']['input-vcf']['value'] = input_path
+            config['script-params']['output-name']['value'] = output_path
+            normalize_output_name(config)
+
+        # keep checkpoints of concurrent jobs apart
+        if get_param(config, 'run-id') is None:
+            config['script-params']['run-id'] = {'value': job_id, 'type': 'string'}
+        return config
+
+    def _run(self, job_id, request):
+        self._update(job_id, status='running', started=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        staging_dir = os.path.join(SERVER_STAGING_DIR, job_id)
+        run_dir = None
+        try:
+            report = RunReport()
+            with report.stage('import_config'):
+                config = self.job_config(job_id, request)
+            output_path = config['script-params']['output-name']['value']
+            self._update(job_id, output=output_path)
+
+            # checkpoints of a run-id the server assigned can never be resumed
+            if get_param(config, 'run-id') == job_id:
+                run_dir = os.path.join(get_param(config, 'work-dir', CHECKPOINT_DIR), job_id)
+
+            # concurrent jobs would compute and write the same cache delta
+            uses_cache = get_param(config, 'annotation-cache') is not None
+            with self._cache_lock if uses_cache else contextlib.nullcontext():
+                run_annotation(config, report, start_hail=False, staging_dir=staging_dir)
+            run_report = output_path.rstrip('/') + '.run-report.json'
+            self._update(job_id, status='succeeded',
+                         run_report=run_report if get_param(config, 'run-report', True) else None)
+        except Exception as e:
+            print(f"Job {job_id} failed: {type(e).__name__}: {e}")
+            self._update(job_id, status='failed', error=f"{type(e).__name__}: {e}")
+        finally:
+            for path in [staging_dir, run_dir]:
+                if path is not None:
+                    try:
+                        get_filesystem(path).rmtree(path)
+                    except Exception as e:
+                        print(f"Could not remove {path} of job {job_id}: {e}")
+            self._update(job_id, finished=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+class AnnotationRequestHandler(http.server.BaseHTTPRequestHandler):
+    """JSON API of an `AnnotationServer`: POST /jobs submits a job, GET /jobs
+    lists jobs and GET /jobs/<id> returns the status of one job."""
+
+    def _reply(self, code, body):
+        data = json.dumps(body, indent=4).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        if path == '/jobs':
+            return self._reply(200, self.server.annotation_server.status())
+        if path.startswith('/jobs/'):
+            job = self.server.annotation_server.status(path[len('/jobs/'):])
+            if job is not None:
+                return self._reply(200, job)
+        self._reply(404, {'error': f"Unknown path {self.path}."})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self._reply(404, {'error': f"Unknown path {self.path}."})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(request, dict):
+                raise ValueError("Expecting a JSON object.")
+            job = self.server.annotation_server.submit(request)
+        except ValueError as e:
+            return self._reply(400, {'error': str(e)})
+        except RuntimeError as e:
+            return self._reply(503, {'error': str(e)})
+        self._reply(202, job)
+
+
+def serve(config_path, port=SERVER_PORT, workers=SERVER_WORKERS):
+    """Start an `AnnotationServer` and accept jobs over HTTP on localhost
+    until interrupted.
+
+    :param config_path: Path to the base config. It sizes the Hail session and is used for inline variant jobs.
+    :type config_path: str
+    :param port: Local port to listen on.
+    :type port: int
+    :param workers: Maximum number of jobs running at a time.
+    :type workers: int
+    """
+
+    annotation_server = AnnotationServer(import_config(config_path), workers)
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), AnnotationRequestHandler)
+    httpd.annotation_server = annotation_server
+    print(f"Serving annotation jobs on http://127.0.0.1:{port}/jobs with {workers} workers.")
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        annotation_server.executor.shutdown(wait=False)
 
 
 
@@ -635,9 +3444,47 @@ if __name__ == '__main__':
                                      add Hail annotations to an input VCF file.')
     
     # Get arguments
-    parser.add_argument('--config', type=str,
-                        help='GCP path to a config with annotation parameters.')
+    parser.add_argument('--config', type=str, nargs='+',
+                        help='GCP path to a config with annotation parameters. \
+                            Several configs are annotated together as a batch.')
+    parser.add_argument('--inputs', type=str, nargs='+', default=[],
+                        help='Batch mode: additional input VCFs annotated with the first config.')
+    parser.add_argument('--preflight-only', action='store_true',
+                        help='Only validate the paths and reference tables in the config.')
+    parser.add_argument('--build-reference', type=str,
+                        help='Instead of annotating, write a reduced GnomAD reference table to this path.')
+    parser.add_argument('--build-local-index', type=str,
+                        help='Instead of annotating, write a local frequency index for the local engine to this path.')
+    parser.add_argument('--build-presence-filter', type=str,
+                        help='Instead of annotating, write a presence filter over the annotation source variants to this .npz path.')
+    parser.add_argument('--false-positive-rate', type=float, default=PRESENCE_FALSE_POSITIVE_RATE,
+                        help='Target false positive rate of the presence filter.')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run a long-running server in one Hail session, accepting annotation jobs over local HTTP.')
+    parser.add_argument('--port', type=int, default=SERVER_PORT,
+                        help='Server mode: local port to listen on.')
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                        help='Server mode: maximum number of jobs running at a time.')
+    parser.add_argument('--n-partitions', type=int,
+                        help='Number of partitions for the reduced GnomAD reference table.')
     args = parser.parse_args()
 
-    # execute main
-    execute_annotation(args.config)
+    if args.preflight_only:
+        for config_path in args.config:
+            preflight(import_config(config_path))
+    elif args.build_reference:
+        build_reduced_reference(import_config(args.config[0]),
+                                args.build_reference,
+                                args.n_partitions)
+    elif args.build_local_index:
+        build_local_index(import_config(args.config[0]), args.build_local_index)
+    elif args.build_presence_filter:
+        build_presence_filter(import_config(args.config[0]), args.build_presence_filter,
+                              args.false_positive_rate)
+    elif args.serve:
+        serve(args.config[0], args.port, args.workers)
+    elif len(args.config) > 1 or args.inputs:
+        execute_batch(args.config, args.inputs)
+    else:
+        # execute main
+        execute_annotation(args.config[0])
@@ -0,0 +1,81 @@
+"""
+Tests of the annotation cache manifest against the local storage backend.
+
+    python -m pytest tests
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hail_annotation as ha
+
+CACHE_DIR = 'gs://cache-bucket/annotation-cache/'
+
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch):
+    monkeypatch.setenv(ha.LOCAL_STORAGE_ENV, str(tmp_path))
+    ha.get_storage_backend.cache_clear()
+    yield tmp_path
+    ha.get_storage_backend.cache_clear()
+
+
+def test_first_update_creates_the_manifest(local_storage):
+    old, new = ha.update_cache_manifest(CACHE_DIR, lambda m: {**m, 'tables': ['annotations.a.ht']})
+
+    assert old == {'tables': [], 'retired': []}
+    assert new == {'tables': ['annotations.a.ht'], 'retired': []}
+    assert ha.read_cache_manifest(CACHE_DIR)[0] == new
+
+
+def test_stale_version_is_rejected(local_storage):
+    ha.update_cache_manifest(CACHE_DIR, lambda m: {**m, 'tables': ['annotations.a.ht']})
+    backend = ha.get_storage_backend()
+    path = os.path.join(CACHE_DIR, ha.CACHE_LATEST)
+    _, stale = backend.read_versioned(path)
+    ha.update_cache_manifest(CACHE_DIR, lambda m: {**m, 'tables': m['tables'] + ['annotations.b.ht']})
+
+    assert not backend.write_if_version(path, '{}', stale)
+    assert ha.read_cache_manifest(CACHE_DIR)[0]['tables'] == ['annotations.a.ht', 'annotations.b.ht']
+
+
+def test_concurrent_change_forces_a_retry(local_storage):
+    calls = []
+
+    def add_table(manifest):
+        calls.append(list(manifest['tables']))
+        if len(calls) == 1:
+            # another run adds a table between this run's read and write
+            ha.update_cache_manifest(CACHE_DIR, lambda m: {**m, 'tables': m['tables'] + ['annotations.other.ht']})
+        return {**manifest, 'tables': manifest['tables'] + ['annotations.mine.ht']}
+
+    _, new = ha.update_cache_manifest(CACHE_DIR, add_table)
+
+    assert calls == [[], ['annotations.other.ht']]
+    assert new['tables'] == ['annotations.other.ht', 'annotations.mine.ht']
+    assert ha.read_cache_manifest(CACHE_DIR)[0] == new
+
+
+def test_update_gives_up_after_retries(local_storage, monkeypatch):
+    monkeypatch.setattr(ha.LocalStorageBackend, 'write_if_version', lambda self, path, text, version: False)
+
+    with pytest.raises(Exception, match='after'):
+        ha.update_cache_manifest(CACHE_DIR, lambda m: m)
+
+
+def test_legacy_generation_number(local_storage):
+    latest = local_storage / 'cache-bucket' / 'annotation-cache' / ha.CACHE_LATEST
+    latest.parent.mkdir(parents=True)
+    latest.write_text('3\n')
+
+    manifest, version = ha.read_cache_manifest(CACHE_DIR)
+
+    assert manifest == {'tables': ['annotations.3.ht'], 'retired': []}
+    # the legacy pointer is replaced by a manifest on the next update
+    _, new = ha.update_cache_manifest(CACHE_DIR, lambda m: {**m, 'tables': m['tables'] + ['annotations.a.ht']})
+    assert json.loads(latest.read_text()) == new == {'tables': ['annotations.3.ht', 'annotations.a.ht'],
+                                                     'retired': []}
@@ -0,0 +1,83 @@
+"""
+Tests of the local filesystem path of the pipeline's I/O: staging a VCF
+with `fake_vcf` and copying outputs with `upload_to_cloud`.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hail_annotation as ha
+
+
+def read_lines(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def test_get_filesystem():
+    assert isinstance(ha.get_filesystem('/tmp/out.tsv'), ha.LocalFileSystem)
+    assert isinstance(ha.get_filesystem('file:///tmp/out.tsv'), ha.LocalFileSystem)
+    assert isinstance(ha.get_filesystem('gs://bucket/out.tsv'), ha.HailFileSystem)
+    assert isinstance(ha.get_filesystem('gs://bucket/out.tsv', jvm=False), ha.FsspecFileSystem)
+
+
+def test_fake_vcf_writes_locally(tmp_path):
+    chunks = [pd.DataFrame([['chr2', 5, 'G', 'C'], ['1', 10, 'A', 'T'], ['1', 10, 'A', 'T']],
+                           columns=['CHROM', 'POS', 'REF', 'ALT']),
+              pd.DataFrame([['X', 1, 'C', 'A']], columns=['CHROM', 'POS', 'REF', 'ALT'])]
+
+    path = ha.fake_vcf(iter(chunks), use_chr=False, output_dir=f'file://{tmp_path}/staging', sites_only=True)
+
+    assert path == f'file://{tmp_path}/staging/fake_vcf.vcf'
+    lines = read_lines(tmp_path / 'staging' / 'fake_vcf.vcf')
+    assert lines[0] == '##fileformat=VCFv4.2'
+    assert lines[1].split('\t') == ['#CHROM'] + ha.SITES_COLUMNS[1:]
+    # each chunk is recoded, sorted and de-duplicated on its own
+    assert [[i.split('\t')[j] for j in [0, 1, 3, 4]] for i in lines[2:]] == [['1', '10', 'A', 'T'], ['2', '5', 'G', 'C'], ['X', '1', 'C', 'A']]
+
+
+def test_fake_vcf_with_genotypes(tmp_path):
+    df = pd.DataFrame([['1', 10, 'A', 'T']], columns=['CHROM', 'POS', 'REF', 'ALT'])
+
+    path = ha.fake_vcf(df, use_chr=True, output_dir=str(tmp_path))
+
+    lines = read_lines(path)
+    assert lines[1].split('\t') == ['#CHROM'] + ha.VCF_COLUMNS[1:]
+    assert lines[2].split('\t')[0] == 'chr1'
+    assert len(lines[2].split('\t')) == len(ha.VCF_COLUMNS)
+
+
+def test_upload_file(tmp_path):
+    (tmp_path / 'out.tsv').write_text('a\tb\n')
+
+    ha.upload_to_cloud(str(tmp_path / 'out.tsv'), f'file://{tmp_path}/dest/out.tsv')
+
+    assert (tmp_path / 'dest' / 'out.tsv').read_text() == 'a\tb\n'
+
+
+def test_upload_directory(tmp_path):
+    (tmp_path / 'out.tsv.bgz').mkdir()
+    (tmp_path / 'out.tsv.bgz' / 'part-0.bgz').write_bytes(b'shard')
+    (tmp_path / 'out.tsv.bgz' / 'manifest.json').write_text('{}')
+
+    ha.upload_to_cloud(str(tmp_path / 'out.tsv.bgz'), str(tmp_path / 'dest' / 'out.tsv.bgz'))
+
+    assert sorted(os.listdir(tmp_path / 'dest' / 'out.tsv.bgz')) == ['manifest.json', 'part-0.bgz']
+    assert (tmp_path / 'dest' / 'out.tsv.bgz' / 'part-0.bgz').read_bytes() == b'shard'
+
+
+def test_upload_to_itself_is_a_no_op(tmp_path, capsys):
+    (tmp_path / 'out.tsv').write_text('a\tb\n')
+
+    # a gs:// path would need Hail if anything were copied
+    ha.upload_to_cloud('gs://bucket/out.tsv', 'gs://bucket/out.tsv')
+    ha.upload_to_cloud(str(tmp_path / 'out.tsv'), str(tmp_path / 'out.tsv'))
+
+    assert capsys.readouterr().out == ''
+    assert os.listdir(tmp_path) == ['out.tsv']
+    assert (tmp_path / 'out.tsv').read_text() == 'a\tb\n'
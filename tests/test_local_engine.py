@@ -0,0 +1,109 @@
+"""
+Behavior tests for the pure NumPy/pandas helpers of the local engine, which
+must split, trim and look up variants the same way the Hail path does.
+
+    python -m pytest tests
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hail_annotation as ha
+
+
+def normalized_rows(rows):
+    df = pd.DataFrame(rows, columns=['CHROM', 'POS', 'REF', 'ALT'])
+    return ha.normalize_vcf_rows(df, use_chr=False, sites_only=True)
+
+
+def write_index(index_dir, variants, values, columns):
+    """Write a local index for variants given as (contig, pos, ref, alt)."""
+    df = pd.DataFrame(variants, columns=['CHROM', 'POS', 'REF', 'ALT'])
+    meta = {'sources': {}, 'columns': columns, 'contigs': {}}
+    for contig, rows in df.groupby('CHROM').indices.items():
+        keys = ha.variant_keys(df.POS.to_numpy()[rows], df.REF.to_numpy()[rows], df.ALT.to_numpy()[rows])
+        order = np.argsort(keys)
+        np.save(os.path.join(index_dir, f'{contig}.keys.npy'), keys[order])
+        np.save(os.path.join(index_dir, f'{contig}.values.npy'), np.asarray(values, dtype=np.float32)[rows][order])
+        meta['contigs'][contig] = len(rows)
+    with open(os.path.join(index_dir, ha.LOCAL_INDEX_META), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def test_min_rep_trims_suffix_then_prefix():
+    pos, ref, alt = ha.min_rep(pd.Series([100, 100, 100, 100]),
+                               pd.Series(['CAG', 'AT', 'A', 'GCC']),
+                               pd.Series(['CTG', 'ATT', 'C', 'GC']))
+    assert pos.tolist() == [101, 100, 100, 100]
+    assert ref.tolist() == ['A', 'A', 'A', 'GC']
+    assert alt.tolist() == ['T', 'AT', 'C', 'G']
+
+
+def test_split_variant_rows_matches_split_multi():
+    variants = ha.split_variant_rows(normalized_rows([['1', 10, 'A', 'C,T'],
+                                                      ['1', 20, 'AT', 'A,*,ATT'],
+                                                      ['2', 5, 'G', 'C']]))
+
+    assert variants[['CHROM', 'POS', 'REF', 'ALT']].values.tolist() == [
+        ['1', 10, 'A', 'C'], ['1', 10, 'A', 'T'], ['1', 20, 'AT', 'A'], ['1', 20, 'A', 'AT'], ['2', 5, 'G', 'C']]
+    # star alleles are dropped but keep their allele index
+    assert variants.a_index.tolist() == [1, 2, 1, 3, 1]
+    assert variants.was_split.tolist() == [True, True, True, True, False]
+    assert variants.old_locus.tolist()[2] == '1:20'
+    assert variants.old_alleles.tolist()[0] == '["A","C","T"]'
+
+
+def test_variant_keys_sort_by_position():
+    keys = ha.variant_keys(np.array([300, 100, 200]), np.array(['A', 'C', 'G']), np.array(['T', 'A', 'C']))
+    assert np.argsort(keys).tolist() == [1, 2, 0]
+    assert (keys >> np.uint64(32)).tolist() == [300, 100, 200]
+
+
+def test_lookup_local_index(tmp_path):
+    meta = write_index(tmp_path, [['1', 10, 'A', 'C'], ['1', 10, 'A', 'T'], ['2', 5, 'G', 'C']],
+                       [[0.1, 0.2], [0.3, np.nan], [0.5, 0.6]], ['efreq', 'gfreq'])
+    variants = pd.DataFrame([['1', 10, 'A', 'T'], ['1', 10, 'A', 'G'], ['2', 5, 'G', 'C'],
+                             ['1', 11, 'A', 'C'], ['X', 5, 'G', 'C']], columns=['CHROM', 'POS', 'REF', 'ALT'])
+
+    values = ha.lookup_local_index(variants, str(tmp_path), meta)
+
+    np.testing.assert_array_equal(values, np.array([[0.3, np.nan], [np.nan, np.nan], [0.5, 0.6],
+                                                    [np.nan, np.nan], [np.nan, np.nan]], dtype=np.float32))
+
+
+def test_annotate_local_writes_sorted_filtered_rows(tmp_path):
+    index_dir = tmp_path / 'index'
+    index_dir.mkdir()
+    write_index(index_dir, [['1', 10, 'A', 'C'], ['2', 5, 'G', 'C']],
+                [[0.001, 0.002, 0.003, 0.004], [0.5, 0.5, 0.5, 0.5]], ['efreq', 'epopmax', 'gfreq', 'gpopmax'])
+
+    input_path = tmp_path / 'input.tsv'
+    input_path.write_text('CHROM\tPOS\tREF\tALT\n2\t5\tG\tC\nchr1\t30\tA\tG\n1\t10\tA\tC,T\n')
+    output_path = tmp_path / 'output.tsv'
+    config = {'gnomad-paths': {'exomes': {'value': 'gs://b/exomes.ht'}, 'genomes': {'value': 'gs://b/genomes.ht'}},
+              'script-params': {'testing': {'value': False},
+                                'allele-frequency-cutoff': {'value': 0.01},
+                                'input-vcf': {'value': str(input_path)},
+                                'output-name': {'value': str(output_path)},
+                                'local-index': {'value': str(index_dir)}}}
+
+    # the index must have been built from the config's sources
+    meta = json.loads((index_dir / ha.LOCAL_INDEX_META).read_text())
+    meta['sources'] = ha.cache_sources(ha.annotation_sources(config))
+    (index_dir / ha.LOCAL_INDEX_META).write_text(json.dumps(meta))
+
+    report = ha.RunReport()
+    ha.annotate_local(config, report)
+
+    output = pd.read_csv(output_path, sep='\t', dtype=str, keep_default_na=False)
+    assert list(output.columns) == ha.LOCAL_ROW_FIELDS + ['efreq', 'epopmax', 'gfreq', 'gpopmax']
+    # 2:5 is common and filtered; the rest are sorted by locus, then alleles
+    assert output.variant.tolist() == ['1:10A>C', '1:10A>T', '1:30A>G']
+    assert output.efreq.tolist() == ['0.001', '0.0', '0.0']
+    assert report.row_counts == {'input': 4, 'after_exomes_filter': 3, 'after_genomes_filter': 3}
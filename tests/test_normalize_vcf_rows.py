@@ -0,0 +1,83 @@
+"""
+Tests of the vectorized VCF row normalization that stages input for Hail.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hail_annotation as ha
+
+
+def variants(rows, **columns):
+    return pd.DataFrame(rows, columns=['CHROM', 'POS', 'REF', 'ALT']).assign(**columns)
+
+
+def test_contig_rank_order():
+    contigs = np.array(['MT', 'Y', '10', 'X', 'GL000192.1', '2', '1', 'X', 'KI270706.1'])
+
+    ranked = contigs[np.argsort(ha.contig_rank(contigs), kind='stable')]
+
+    assert ranked.tolist() == ['1', '2', '10', 'X', 'X', 'Y', 'MT', 'GL000192.1', 'KI270706.1']
+
+
+@pytest.mark.parametrize('use_chr, expected', [(True, ['chr1', 'chr2', 'chrX']), (False, ['1', '2', 'X'])])
+def test_chr_prefix_recode(use_chr, expected):
+    rows = ha.normalize_vcf_rows(variants([['chrX', 1, 'A', 'C'], ['1', 1, 'A', 'C'], ['chr2', 1, 'A', 'C']]),
+                                 use_chr=use_chr)
+
+    assert rows.CHROM.tolist() == expected
+
+
+def test_sort_and_dedup():
+    rows = ha.normalize_vcf_rows(variants([['MT', 5, 'A', 'C'],
+                                           ['Y', 5, 'A', 'C'],
+                                           ['X', 20, 'A', 'C'],
+                                           ['X', 3, 'A', 'T'],
+                                           ['chrX', 3, 'A', 'T'],
+                                           ['X', 3, 'A', 'G'],
+                                           ['22', 7, 'A', 'C']]),
+                                 use_chr=False, sites_only=True)
+
+    assert rows[['CHROM', 'POS', 'REF', 'ALT']].values.tolist() == [
+        ['22', 7, 'A', 'C'], ['X', 3, 'A', 'G'], ['X', 3, 'A', 'T'], ['X', 20, 'A', 'C'],
+        ['Y', 5, 'A', 'C'], ['MT', 5, 'A', 'C']]
+    assert list(rows.columns) == ha.SITES_COLUMNS
+
+
+def test_optional_columns_follow_their_rows():
+    rows = ha.normalize_vcf_rows(variants([['2', 1, 'A', 'C'], ['1', 1, 'A', 'C']],
+                                          ID=['rs2', None], QUAL=['30', '40']), use_chr=False)
+
+    assert rows.ID.tolist() == ['.', 'rs2']
+    assert rows.QUAL.tolist() == ['40', '30']
+    assert rows.FILTER.tolist() == ['.', '.']
+    assert rows[ha.FAKE_SAMPLE].tolist() == ['0/1', '0/1']
+    assert list(rows.columns) == ha.VCF_COLUMNS
+
+
+def test_empty_input():
+    rows = ha.normalize_vcf_rows(variants([]), sites_only=True)
+
+    assert rows.empty and list(rows.columns) == ha.SITES_COLUMNS
+
+
+def test_missing_columns():
+    with pytest.raises(pd.errors.ParserError, match='missing VCF variant info'):
+        ha.normalize_vcf_rows(pd.DataFrame({'CHROM': ['1'], 'POS': [1], 'REF': ['A']}))
+
+
+def test_missing_values():
+    with pytest.raises(pd.errors.ParserError, match='columns POS, ALT contain missing data'):
+        ha.normalize_vcf_rows(variants([['1', None, 'A', None], ['1', 2, 'A', 'C']]))
+
+
+def test_non_integer_position():
+    with pytest.raises(pd.errors.ParserError, match='non-integer'):
+        ha.normalize_vcf_rows(variants([['1', '10', 'A', 'C'], ['1', 'ten', 'A', 'C']]))
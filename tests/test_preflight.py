@@ -0,0 +1,121 @@
+"""
+Offline tests of config loading and preflight checks, serving gs:// paths
+from a local directory through HAIL_ANNOTATE_LOCAL_STORAGE.
+
+    python -m pytest tests
+"""
+
+import gzip
+import json
+import os
+import stat
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hail_annotation as ha
+
+ROW_TYPE = ('locus:Locus(GRCh37),alleles:Array[String],freq:Array[Struct{AC:Int32,AF:Float64}],'
+            'popmax:Array[Struct{AF:Float64,pop:String}]')
+
+
+def write_table_metadata(table_dir, row_type):
+    table_dir.mkdir(parents=True)
+    table_type = f'Table{{global:Struct{{}},key:[locus,alleles],row:Struct{{{row_type}}}}}'
+    (table_dir / 'metadata.json.gz').write_bytes(gzip.compress(json.dumps({'table_type': table_type}).encode()))
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """A local tree with a config, two GnomAD tables, an input and an output bucket."""
+    monkeypatch.setenv(ha.LOCAL_STORAGE_ENV, str(tmp_path))
+    ha.get_storage_backend.cache_clear()
+    ha.fetch_config_text.cache_clear()
+    ha.table_row_fields.cache_clear()
+
+    write_table_metadata(tmp_path / 'ref-bucket' / 'exomes.ht', ROW_TYPE)
+    write_table_metadata(tmp_path / 'ref-bucket' / 'genomes.ht', ROW_TYPE)
+    (tmp_path / 'in-bucket').mkdir()
+    (tmp_path / 'in-bucket' / 'input.vcf').write_text('#CHROM\tPOS\tREF\tALT\n1\t10\tA\tC\n')
+    (tmp_path / 'out-bucket').mkdir()
+    yield tmp_path
+    ha.get_storage_backend.cache_clear()
+    ha.fetch_config_text.cache_clear()
+    ha.table_row_fields.cache_clear()
+
+
+def write_config(root, **params):
+    config = {'gnomad-paths': {'exomes': {'value': 'gs://ref-bucket/exomes.ht', 'type': 'google-cloud-path'},
+                               'genomes': {'value': 'gs://ref-bucket/genomes.ht', 'type': 'google-cloud-path'}},
+              'script-params': {'testing': {'value': False, 'type': 'boolean'},
+                                'allele-frequency-cutoff': {'value': 0.1, 'type': 'float'},
+                                'input-vcf': {'value': 'gs://in-bucket/input.vcf', 'type': 'google-cloud-path'},
+                                'output-name': {'value': 'gs://out-bucket/output.tsv', 'type': 'google-cloud-path'}}}
+    for name, value in params.items():
+        config['script-params'][name.replace('_', '-')]['value'] = value
+    (root / 'config-bucket').mkdir(exist_ok=True)
+    (root / 'config-bucket' / 'config.json').write_text(json.dumps(config))
+    return ha.import_config('gs://config-bucket/config.json')
+
+
+def preflight_lines(config, capsys):
+    try:
+        ha.preflight(config)
+        failed = None
+    except Exception as e:
+        failed = str(e)
+    lines = [i.strip() for i in capsys.readouterr().out.splitlines() if i.strip().startswith('[')]
+    return failed, lines
+
+
+def test_import_config_reads_local_storage(storage):
+    config = write_config(storage)
+    assert config['script-params']['input-vcf']['value'] == 'gs://in-bucket/input.vcf'
+
+
+def test_import_config_missing_bucket(storage):
+    with pytest.raises(Exception, match='Cannot locate input config bucket'):
+        ha.import_config('gs://no-such-bucket/config.json')
+
+
+def test_preflight_passes(storage, capsys):
+    failed, lines = preflight_lines(write_config(storage), capsys)
+
+    assert failed is None
+    assert len(lines) == 4 and all(i.startswith('[PASS]') for i in lines)
+
+
+def test_preflight_missing_popmax(storage, capsys):
+    (storage / 'ref-bucket' / 'genomes.ht' / 'metadata.json.gz').unlink()
+    (storage / 'ref-bucket' / 'genomes.ht').rmdir()
+    write_table_metadata(storage / 'ref-bucket' / 'genomes.ht',
+                         'locus:Locus(GRCh37),alleles:Array[String],freq:Array[Struct{AC:Int32,AF:Float64}]')
+
+    failed, lines = preflight_lines(write_config(storage), capsys)
+
+    assert failed == 'Preflight failed for: genomes.'
+    assert '[FAIL] annotation-sources/genomes: gs://ref-bucket/genomes.ht - table is missing fields: popmax' in lines
+    assert '[PASS] annotation-sources/exomes: gs://ref-bucket/exomes.ht' in lines
+
+
+def test_preflight_missing_input(storage, capsys):
+    failed, lines = preflight_lines(write_config(storage, input_vcf='gs://in-bucket/missing.vcf'), capsys)
+
+    assert failed == 'Preflight failed for: input-vcf.'
+    assert '[FAIL] script-params/input-vcf: gs://in-bucket/missing.vcf - file does not exist' in lines
+
+
+def test_preflight_unwritable_output(storage, capsys, monkeypatch):
+    out_bucket = storage / 'out-bucket'
+    out_bucket.chmod(stat.S_IRUSR | stat.S_IXUSR)
+    # root may write anywhere, so judge access by the permission bits alone
+    monkeypatch.setattr(ha.os, 'access', lambda path, mode: not (mode & os.W_OK) or bool(os.stat(path).st_mode & stat.S_IWUSR))
+
+    try:
+        failed, lines = preflight_lines(write_config(storage), capsys)
+    finally:
+        out_bucket.chmod(stat.S_IRWXU)
+
+    assert failed == 'Preflight failed for: output-name.'
+    assert '[FAIL] script-params/output-name: gs://out-bucket/output.tsv - no write permission on bucket out-bucket' in lines
@@ -0,0 +1,69 @@
+"""
+Tests that a presence filter never rules out a variant of its sources, so
+skipping the joins of novel variants leaves the outputs unchanged.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hail_annotation as ha
+
+# split, min_rep'd variants as stored by the sources, on GRCh38-style contigs
+SOURCE_VARIANTS = [['chr1', 100, 'A', 'C'],
+                   ['chr1', 100, 'A', 'T'],
+                   ['chr1', 200, 'AT', 'A'],
+                   ['chr2', 300, 'G', 'GA'],
+                   ['chrX', 50, 'C', 'G']]
+
+
+def build_filter(variants, false_positive_rate=1e-6):
+    # mirrors build_presence_filter, for variants of a single table
+    df = pd.DataFrame(variants, columns=['contig', 'pos', 'ref', 'alt'])
+    n_keys = len(df)
+    n_bits = int(np.ceil(-n_keys * np.log(false_positive_rate) / np.log(2) ** 2))
+    n_hashes = max(1, int(round(n_bits / n_keys * np.log(2))))
+    bits = np.zeros((n_bits + 7) // 8, dtype=np.uint8)
+    for contig, part in df.groupby('contig'):
+        keys = ha.presence_keys(np.full(len(part), contig.replace('chr', ''), dtype=object),
+                                part.pos.to_numpy(), part.ref.to_numpy(), part.alt.to_numpy())
+        ha.set_presence_bits(bits, keys, n_bits, n_hashes)
+    return {'bits': bits, 'n_bits': n_bits, 'n_hashes': n_hashes, 'sources': {}}
+
+
+def novel(rows, presence_filter):
+    df = pd.DataFrame(rows, columns=['CHROM', 'POS', 'REF', 'ALT'])
+    return ha.novel_alleles(ha.normalize_vcf_rows(df, use_chr=False, sites_only=True), presence_filter).tolist()
+
+
+def test_no_false_negatives():
+    # every inserted variant, probed with and without the 'chr' prefix
+    presence_filter = build_filter(SOURCE_VARIANTS)
+    rows = [[chrom.replace('chr', '') if i % 2 else chrom, pos, ref, alt]
+            for i, (chrom, pos, ref, alt) in enumerate(SOURCE_VARIANTS)]
+
+    assert set(novel(rows, presence_filter)) == {'NOVEL=0'}
+
+
+def test_flags_line_up_with_alts():
+    presence_filter = build_filter(SOURCE_VARIANTS)
+
+    flags = novel([['chr1', 100, 'A', 'G,T,C'],
+                   # min_rep trims ATT>AT to the stored AT>A, but not ATT>A
+                   ['1', 200, 'ATT', 'AT,A'],
+                   ['chr2', 300, 'G', 'GA'],
+                   ['3', 10, 'A', 'C']], presence_filter)
+
+    assert flags == ['NOVEL=1,0,0', 'NOVEL=0,1', 'NOVEL=0', 'NOVEL=1']
+
+
+def test_bits_set_per_key():
+    presence_filter = build_filter(SOURCE_VARIANTS[:1])
+    n_set = int(np.unpackbits(presence_filter['bits']).sum())
+
+    assert 1 <= n_set <= presence_filter['n_hashes']